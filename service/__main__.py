@@ -1,39 +1,64 @@
 import json
-import os
-import signal
-from queue import Full
-from time import sleep
+import pickle
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Empty, Full
 from datetime import datetime, timedelta
-from typing import Callable, Tuple, Optional, Dict, Set
-from multiprocessing import current_process, Queue, Process, Pool
+from time import monotonic
+from typing import TYPE_CHECKING, Callable, Tuple, Optional, Dict, Set
+from multiprocessing import current_process, Event, Queue, Pipe, Process
+from multiprocessing.connection import Connection
+from threading import Lock
 
 from .acl import SqliteAccessControlList
 from .httpservice import start_http_service
-from .steam.api import SteamApi, SteamApiError
 from .steam.cache import SqliteSteamProfileCache
 from .steam.model import SteamMembersPage, SteamID, SteamUserProfile
 
+if TYPE_CHECKING:
+    # imported lazily by the processes that talk to Steam (pulls in requests
+    # and lxml, which the other processes do not need)
+    from .steam.api import SteamApi
+
 CONFIG_FILE = 'config.json'
 
-# amount of seconds to wait after unsuccessful Steam member request
+# amount of seconds to wait after unsuccessful Steam member/profile request
+# (doubled after each consecutive failure, up to G_MAX_RETRY_SECS, plus up to
+# G_RETRY_SECS of random jitter)
 G_RETRY_SECS = 10.0
+G_MAX_RETRY_SECS = 300.0
 
 # how many seconds to wait before dropping pending group data?
 # (this time should never trip unless there is a serious bug!)
 G_UPDATE_QUEUE_TIMEOUT = 5.0
 
+# how many polls in a row may be answered with "group not modified" before
+# forcing a full update? (re-sends data that may have been lost downstream)
+G_MAX_CONDITIONAL_POLLS = 10
+
+# how often should blocked processes check whether they should shut down?
+G_SHUTDOWN_POLL_SECS = 1.0
+
 # how many times should we attempt to resolve a single profile into a Steam ID
 # before declaring fatal failure? (used to retry failed HTTP requests)
 G_MAX_RESOLVE_ATTEMPTS = 3
 
-# how many processes (profile HTTP requests) should we maintain at the same
-# time?
-G_NUM_RESOLVER_PROCESSES = 4
+# longest wait between two attempts to resolve a profile (the whole batch
+# waits for its slowest profile, so this is kept short)
+G_MAX_RESOLVE_RETRY_SECS = 5.0
+
+# how many threads (profile HTTP requests) should we maintain at the same
+# time? (also the size of the shared keep-alive connection pool)
+G_NUM_RESOLVER_THREADS = 4
 
 # how long should a cache entry stay on disk without being accessed before
 # expiring?
 G_CACHE_TTL = timedelta(days=7)
 
+# how often should the profile cache refresh its query planner statistics and
+# truncate its write-ahead log?
+G_CACHE_OPTIMIZE_SECS = 3600.0
+
 # address for the HTTP service to listen on
 #
 # IMPORTANT:
@@ -55,31 +80,36 @@ def main() -> int:
     cache_file: str = config['cache_file']
     acl_file: str = config['acl_file']
     service_port: int = config['service_port']
+    num_resolvers: int = config.get('resolver_concurrency', G_NUM_RESOLVER_THREADS)
+    steam_api_key: Optional[str] = config.get('steam_api_key') or None
 
     auto_allow: Dict[str, str] = config['allowed']
     auto_deny: Dict[str, str] = config['denied']
 
     log('preparing queues...')
     q_group_updates = Queue(1)
-    q_resolved_profiles = Queue(1)
+    # single producer/consumer -> plain pipe (no feeder thread or locking)
+    rx_resolved_profiles, tx_resolved_profiles = Pipe(duplex=False)
+    acl_ready = Event()
+    shutdown = Event()
 
     log('preparing processes...')
     proc_poller = Process(
         target=p_group_poller,
         name='POLLER',
-        args=(q_group_updates, group_id, interval),
+        args=(q_group_updates, group_id, interval, shutdown),
         daemon=True)
 
     proc_resolver = Process(
         target=p_resolver,
         name='RESOLVER',
-        args=(q_group_updates, q_resolved_profiles, cache_file),
+        args=(q_group_updates, tx_resolved_profiles, cache_file, shutdown, num_resolvers, steam_api_key),
         daemon=False)
 
     proc_acl_updater = Process(
         target=p_acl_updater,
         name='ACL-UPDATER',
-        args=(q_resolved_profiles, acl_file, auto_allow, auto_deny),
+        args=(rx_resolved_profiles, acl_file, acl_ready, shutdown, auto_allow, auto_deny),
         daemon=True)
 
     log('spawning processes...')
@@ -87,18 +117,25 @@ def main() -> int:
     proc_resolver.start()
     proc_acl_updater.start()
 
-    log('waiting for ACL database file creation...')
-    while not os.path.isfile(acl_file):
-        sleep(1.0)
+    log('waiting for ACL database initialization...')
+    acl_ready.wait()
 
     log(f'starting HTTP service on port {service_port}')
-    acl = SqliteAccessControlList.open(acl_file)
+    # requests are served from multiple threads -> serialize ACL access
+    acl = SqliteAccessControlList.open(acl_file, create=False, check_same_thread=False)
+    acl_lock = Lock()
+
+    def is_allowed(steam_id: str) -> bool:
+        with acl_lock:
+            return acl.find(steam_id) is not None
+
     start_http_service(
         addr=(G_LISTEN_HOSTNAME, service_port),
-        is_allowed=lambda steam_id: acl.find(steam_id) is not None,
+        is_allowed=is_allowed,
     )
 
     log('shutdown process...')
+    shutdown.set()
 
     log('awaiting sub-process shutdown...')
     for subproc in [proc_poller, proc_resolver, proc_acl_updater]:
@@ -111,7 +148,7 @@ def main() -> int:
 
 # region Sub-Processes
 
-def p_group_poller(q_group_updates: Queue, group_id: str, interval: int):
+def p_group_poller(q_group_updates: Queue, group_id: str, interval: int, shutdown: Event):
     """
     Group Poller Process
 
@@ -126,67 +163,103 @@ def p_group_poller(q_group_updates: Queue, group_id: str, interval: int):
     :param q_group_updates: queue to put group updates into
     :param group_id: ID of the Steam group we are polling (found at the end of group URL)
     :param interval: interval (in seconds) between group checks
+    :param shutdown: event signaling this process to stop
     """
     assert interval >= 30, f'interval is too short ({interval} secs)'
+    from .steam.api import SteamApi, SteamApiError, SteamNotModified
 
     log = mklog()
     log('starting...')
     num_requests = 0
 
     api = SteamApi(on_error=log_error)
+    num_conditional_polls = 0  # since the last update sent downstream
+    num_consecutive_errors = 0
 
     try:
-        while True:
+        while not shutdown.is_set():
             num_requests += 1
 
             try:
-                members_page = api.members(group_id)
+                conditional = 0 < num_conditional_polls < G_MAX_CONDITIONAL_POLLS
+                members_page = api.members(group_id, conditional=conditional)
                 profile_urls = [member.profile_url for member in members_page.members]
                 q_group_updates.put(profile_urls, timeout=G_UPDATE_QUEUE_TIMEOUT)
+                num_conditional_polls = 1
+                num_consecutive_errors = 0
                 log(f'{len(members_page)} members found and sent for update')
+            except SteamNotModified:
+                num_conditional_polls += 1
+                num_consecutive_errors = 0
+                log('group not modified since last update')
             except SteamApiError as ex:
+                delay = retry_delay(num_consecutive_errors)
+                num_consecutive_errors += 1
                 log(f'API ERROR: {ex}')
-                log(f'retrying in {G_RETRY_SECS} seconds...')
-                sleep(G_RETRY_SECS)
+                log(f'retrying in {delay:.1f} seconds...')
+                shutdown.wait(delay)
                 continue
             except Full:
+                num_conditional_polls = 0
+                num_consecutive_errors = 0
                 log(f'WARNING: q_group_updates queue is NOT READY! STATUS DATA WAS LOST!')
                 # even if the queue will be released at some point, this data
                 # may quickly become stale and outdated - it's best to re-fetch
 
             log(f'sleeping {interval} secs...')
-            sleep(interval)
+            shutdown.wait(interval)
     except KeyboardInterrupt:
         log('CTRL+C PRESSED -> SHUTTING DOWN...')
 
     log(f'shutdown complete: {num_requests} requests made...')
 
 
-def init_resolve_one_worker():
-    # block SIGINT to avoid KeyboardInterrupt exceptions
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-
-def resolve_one(profile_url: str) -> Tuple[str, Optional[SteamUserProfile], int]:
+def resolve_one(
+        api: 'SteamApi',
+        profile_url: str,
+        shutdown: Event,
+) -> Tuple[str, Optional[SteamUserProfile], int]:
     """
     Resolve a single Steam user profile
 
     Note:
         None is returned instead of a Steam ID if the lookup consistently
-        failed to obtain a proper profile page for this Steam member.
+        failed to obtain a proper profile page for this Steam member, or if
+        `shutdown` was signaled while waiting to retry.
+
+        Failed attempts are retried after a short backoff (see
+        G_MAX_RESOLVE_RETRY_SECS) - longer outages are left to the next poll.
 
+    :param api: Steam API instance (shared between resolver threads)
     :param profile_url: member's Steam profile URL
-    :return: (profile_url, steam_profile|None, num_requests_made)
+    :param shutdown: event signaling the resolver process to stop
+    :return: (profile_url, steam_profile|None, num_attempts_made)
     """
+    from .steam.api import SteamApiError
+
     log = mklog()
-    api = SteamApi(on_error=log_error)
+    use_web_api = bool(api.api_key)
     for attempt in range(G_MAX_RESOLVE_ATTEMPTS):
         def log_ex(msg: str = ''):
             log(f'[{attempt + 1}/{G_MAX_RESOLVE_ATTEMPTS}] {msg}')
 
+        if attempt > 0 and shutdown.wait(min(retry_delay(attempt - 1), G_MAX_RESOLVE_RETRY_SECS)):
+            log(f'WARNING: SHUTTING DOWN; PROFILE NOT RESOLVED: {profile_url}')
+            return profile_url, None, attempt
+
         try:
             log_ex(f'resolving profile {profile_url}')
-            profile = api.profile(profile_url)
+            profile = None
+            if use_web_api:
+                try:
+                    profile = api.web_profile(profile_url)
+                except SteamApiError as ex:
+                    # don't keep retrying it (bad key, rate limit...) - the
+                    # profile page is tried right away instead
+                    use_web_api = False
+                    log_ex(f'WEB API ERROR: {ex} (falling back to profile page)')
+
+            profile = profile or api.profile(profile_url)
             log_ex(f'resolved: {profile_url} -> {repr(profile)}')
             return profile_url, profile, attempt + 1
         except SteamApiError as ex:
@@ -196,7 +269,14 @@ def resolve_one(profile_url: str) -> Tuple[str, Optional[SteamUserProfile], int]
     return profile_url, None, G_MAX_RESOLVE_ATTEMPTS
 
 
-def p_resolver(q_group_updates: Queue, q_resolved_profiles: Queue, profile_cache_file: str):
+def p_resolver(
+        q_group_updates: Queue,
+        tx_resolved_profiles: Connection,
+        profile_cache_file: str,
+        shutdown: Event,
+        num_resolvers: int = G_NUM_RESOLVER_THREADS,
+        steam_api_key: Optional[str] = None,
+):
     """
     Steam Profile Resolver Process
 
@@ -205,27 +285,35 @@ def p_resolver(q_group_updates: Queue, q_resolved_profiles: Queue, profile_cache
     cache.
 
     :param q_group_updates: [IN] List[str] - list of profile URLs from a Steam group member list
-    :param q_resolved_profiles: [OUT] Dict[str, SteamUserProfile] - {profile_url: steam_user_profile} units
+    :param tx_resolved_profiles: [OUT] Dict[str, SteamUserProfile] - {profile_url: steam_user_profile} units
     :param profile_cache_file: file path to the local profile cache
+    :param shutdown: event signaling this process to stop
+    :param num_resolvers: max amount of profile requests in flight at the same time
+    :param steam_api_key: Steam Web API key; profiles are scraped from HTML pages if not provided
     """
+    from .steam.api import SteamApi
+
     log = mklog()
-    log('starting...')
+    log(f'starting ({num_resolvers} concurrent resolvers)...')
     num_outbound_requests = 0
     num_cache_hits = 0
 
     cache = SqliteSteamProfileCache.open(profile_cache_file)
     cache_ttl = G_CACHE_TTL
+    next_cache_optimize = monotonic() + G_CACHE_OPTIMIZE_SECS
 
-    resolver_pool = Pool(G_NUM_RESOLVER_PROCESSES, init_resolve_one_worker)
+    # resolving is pure network I/O -> threads sharing one keep-alive session
+    api = SteamApi(on_error=log_error, pool_size=num_resolvers, api_key=steam_api_key)
+    resolver_pool = ThreadPoolExecutor(max_workers=num_resolvers)
     try:
-        while True:
+        while not shutdown.is_set():
+            try:
+                profile_urls = q_group_updates.get(timeout=G_SHUTDOWN_POLL_SECS)
+            except Empty:
+                continue
+
             # get initial profiles from cache
-            profiles: Dict[str, Optional[SteamUserProfile]] = \
-                {
-                    profile_url: cache.get(profile_url)
-                    for profile_url
-                    in q_group_updates.get()
-                }
+            profiles: Dict[str, Optional[SteamUserProfile]] = cache.get_many(profile_urls)
 
             # profiles not cached yet are "missing"
             missing_profiles = [profile_url for profile_url, profile in profiles.items() if not profile]
@@ -234,41 +322,54 @@ def p_resolver(q_group_updates: Queue, q_resolved_profiles: Queue, profile_cache
 
             # resolve remaining profiles via Steam API in parallel
             missed_profile_urls = set()
-            for profile_url, profile, num_attempts in resolver_pool.map(resolve_one, missing_profiles):
+            resolved_profiles = []
+            pending = [resolver_pool.submit(resolve_one, api, url, shutdown) for url in missing_profiles]
+            for future in as_completed(pending):
+                profile_url, profile, num_attempts = future.result()
                 if profile:
                     profiles[profile_url] = profile
-                    cache.put(profile_url, profile, cache_ttl)
+                    resolved_profiles.append((profile_url, profile, cache_ttl))
                 else:
                     missed_profile_urls.add(profile_url)
 
                 num_outbound_requests += num_attempts
 
+            # cache whatever was resolved (in one transaction)
+            if resolved_profiles:
+                cache.put_many(resolved_profiles)
+
             # disqualify this work unit if there are still profiles missing
             if missed_profile_urls:
                 log(f'WARNING: RESOLVE FAILED ({len(missed_profile_urls)} PROFILES MISSING)')
                 for profile_url in missed_profile_urls:
                     log(f'MISSING PROFILE: {profile_url}')
             else:
-                q_resolved_profiles.put(profiles)
+                tx_resolved_profiles.send_bytes(pickle.dumps(profiles, pickle.HIGHEST_PROTOCOL))
 
             # work unit complete -> expire entries
             num_expired = cache.expire()
             if num_expired > 0:
                 log(f'expired {num_expired} cache entries')
 
+            if monotonic() >= next_cache_optimize:
+                cache.optimize()
+                cache.checkpoint()
+                next_cache_optimize = monotonic() + G_CACHE_OPTIMIZE_SECS
+
     except KeyboardInterrupt:
         log('CTRL+C -> SHUTTING DOWN')
     finally:
-        resolver_pool.close()
-        resolver_pool.join()
+        resolver_pool.shutdown(wait=True)
         cache.close()
 
     log(f'shutdown complete: {num_outbound_requests} API requests ({num_cache_hits} cache hits)')
 
 
 def p_acl_updater(
-        q_resolved_profiles: Queue,
+        rx_resolved_profiles: Connection,
         acl_file: str,
+        acl_ready: Event,
+        shutdown: Event,
         auto_allow: Optional[Dict[str, str]] = None,
         auto_deny: Optional[Dict[str, str]] = None,
 ):
@@ -290,33 +391,32 @@ def p_acl_updater(
     for steam_id in auto_deny_ids:
         acl.remove(steam_id)
 
+    acl_ready.set()
+
     try:
-        while True:
-            profiles: Dict[str, SteamUserProfile] = q_resolved_profiles.get()
+        while not shutdown.is_set():
+            if not rx_resolved_profiles.poll(G_SHUTDOWN_POLL_SECS):
+                continue
+
+            profiles: Dict[str, SteamUserProfile] = pickle.loads(rx_resolved_profiles.recv_bytes())
             now = datetime.now()
 
             # prevent auto-allow members from expiring
-            [acl.update_last_seen(steam_id, now) for steam_id in auto_allow_ids]
+            acl.touch_many(auto_allow_ids, now)
 
-            # remove auto-allow and auto-deny profiles:
+            # skip auto-allow and auto-deny profiles:
             #  auto-allow profiles were added at INIT and updated just now
             #  auto-deny  profiles were removed at INIT
-            auto_urls = {
-                profile_url
-                for profile_url, profile
-                in profiles.items()
-                if profile.steam_id in auto_ids
-            }
-
-            for profile_url in auto_urls:
-                del profiles[profile_url]
+            dynamic_users = [
+                (profile.steam_id, profile.name)
+                for profile
+                in profiles.values()
+                if profile.steam_id not in auto_ids
+            ]
 
             # add/update what's left
-            log(f'{len(profiles)} dynamic profiles updated')
-            for profile_url, profile in profiles.items():
-                updated = acl.update_last_seen(profile.steam_id, ts=now)
-                if not updated:
-                    acl.add(profile.steam_id, profile.name, added_on=now, last_seen=now)
+            log(f'{len(dynamic_users)} dynamic profiles updated')
+            acl.upsert_many(dynamic_users, now)
 
             # expire what wasn't added/updated by previous steps
             num_expired = acl.expire(min_last_seen=now)
@@ -360,6 +460,15 @@ def print_members(page: SteamMembersPage):
     log()
 
 
+def retry_delay(num_consecutive_errors: int) -> float:
+    """
+    :param num_consecutive_errors: amount of failed attempts right before this one
+    :return: seconds to wait before the next attempt (exponential backoff + jitter)
+    """
+    backoff = G_RETRY_SECS * 2 ** min(num_consecutive_errors, 5)
+    return min(G_MAX_RETRY_SECS, backoff) + random.uniform(0, G_RETRY_SECS)
+
+
 def get_config(filename: str = CONFIG_FILE) -> dict:
     with open(filename, 'r') as f:
         return json.load(f)
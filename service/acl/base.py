@@ -7,7 +7,7 @@ Author:
 
 from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import NamedTuple, Optional, Iterator
+from typing import NamedTuple, Optional, Iterator, Iterable, Tuple
 
 __all__ = [
     'AclEntry',
@@ -96,6 +96,56 @@ class AbstractAccessControlList(ABC):
         :return: True if entry was found and updated; False if entry not found
         """
 
+    def bulk_add(self, users: Iterable[Tuple[str, str]], now: Optional[datetime] = None) -> int:
+        """
+        Add multiple users to the access list
+
+        Note:
+            Override this method if the data store can do this in bulk
+
+        :param users: (steam_id, name) pairs; users already present are skipped
+        :param now: timestamp to use as added on (and last seen) time
+        :return: amount of users added
+        """
+        return sum(self.add(steam_id, name, now) for steam_id, name in users)
+
+    def upsert_many(self, users: Iterable[Tuple[str, str]], now: datetime):
+        """
+        Mark the given users as seen at `now`, adding the ones missing
+
+        Note:
+            Override this method if the data store can do this in bulk
+
+        :param users: (steam_id, name) pairs
+        :param now: timestamp to use as last seen (and added on) time
+        """
+        for steam_id, name in users:
+            if not self.update_last_seen(steam_id, now):
+                self.add(steam_id, name, now)
+
+    def touch_many(self, steam_ids: Iterable[str], ts: datetime) -> int:
+        """
+        Update the last_seen timestamp for all the given users
+
+        Note:
+            Override this method if the data store can do this in bulk
+
+        :param steam_ids: Steam IDs of the users
+        :param ts: timestamp to update the last seen time to
+        :return: amount of entries found and updated
+        """
+        return sum(self.update_last_seen(steam_id, ts) for steam_id in steam_ids)
+
+    def clear(self):
+        """
+        Remove all users from the access list
+
+        Note:
+            Override this method if the data store can do this in bulk
+        """
+        for entry in list(self.entries()):
+            self.remove(entry.steam_id)
+
     @abstractmethod
     def expire(self, min_last_seen: datetime) -> int:
         """
@@ -8,8 +8,12 @@ Author:
 from __future__ import annotations
 
 import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, Iterator
+from typing import Optional, Iterator, Iterable, Tuple
+from urllib.parse import unquote, urlsplit
 
 import sqlite3
 
@@ -18,6 +22,113 @@ from .base import AclEntry, AbstractAccessControlList
 __all__ = ['SqliteAccessControlList']
 
 SQLITE_TIMEOUT = 5.0  # secs
+SQLITE_CACHED_STATEMENTS = 256
+
+# applied to every connection at open time
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',  # 256 MiB
+    'PRAGMA cache_size=-65536',  # 64 MiB
+    'PRAGMA busy_timeout=5000',  # msecs
+)
+
+# INSERT ... ON CONFLICT DO UPDATE (SQLite 3.24+) adds or refreshes a user in
+# one statement; older builds run an UPDATE and an INSERT OR IGNORE instead
+SQLITE_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24)
+
+# how many find() results to keep in memory (LRU)
+FIND_CACHE_SIZE = 4096
+
+# how many rows entries() fetches from SQLite at a time
+ENTRIES_BATCH_SIZE = 128
+
+# timestamps are stored as INTEGER microseconds since the epoch - see
+# _to_epoch_us() and _from_epoch_us()
+_SQL_NOW_US = '''CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER)'''
+
+_SQL_CREATE = f'''
+    CREATE TABLE allowed_users (
+        steam_id   TEXT UNIQUE NOT NULL PRIMARY KEY,
+        name       TEXT        NOT NULL DEFAULT '',
+        added_on   INTEGER     NOT NULL DEFAULT ({_SQL_NOW_US}),
+        last_seen  INTEGER     NOT NULL DEFAULT ({_SQL_NOW_US})
+    )
+'''
+
+_SQL_LEN = '''SELECT COUNT(*) FROM allowed_users'''
+
+_SQL_ENTRIES = '''
+    SELECT steam_id, name, added_on, last_seen
+    FROM allowed_users
+'''
+
+_SQL_FIND = '''
+    SELECT name, added_on, last_seen
+    FROM allowed_users
+    WHERE steam_id=?
+    LIMIT 1
+'''
+
+_SQL_ADD = '''
+    INSERT OR IGNORE
+    INTO allowed_users
+    (steam_id, name, added_on, last_seen)
+    VALUES
+    (?, ?, ?, ?)
+'''
+
+_SQL_UPSERT = '''
+    INSERT INTO allowed_users
+    (steam_id, name, added_on, last_seen)
+    VALUES
+    (?, ?, ?, ?)
+    ON CONFLICT(steam_id) DO UPDATE SET last_seen=excluded.last_seen
+'''
+
+_SQL_REMOVE = '''
+    DELETE FROM allowed_users
+    WHERE steam_id=?
+'''
+
+_SQL_TOUCH = '''
+    UPDATE allowed_users
+    SET last_seen=?
+    WHERE steam_id=?
+'''
+
+_SQL_EXPIRE = '''
+    DELETE FROM allowed_users
+    WHERE last_seen < ?
+'''
+
+# noinspection SqlWithoutWhere
+_SQL_CLEAR = '''DELETE FROM allowed_users'''
+
+
+def _to_epoch_us(ts: datetime) -> int:
+    # integer arithmetic keeps the microseconds exact (float timestamps don't)
+    return int(ts.replace(microsecond=0).timestamp()) * 1_000_000 + ts.microsecond
+
+
+def _now_us() -> int:
+    # current time without constructing a datetime (see _to_epoch_us())
+    return time.time_ns() // 1_000
+
+
+def _from_epoch_us(us: int) -> datetime:
+    return datetime.fromtimestamp(us // 1_000_000).replace(microsecond=us % 1_000_000)
+
+
+def _db_path(dbfile: str, uri: bool) -> str:
+    # file:path?query -> path
+    return unquote(urlsplit(dbfile).path) if uri else dbfile
+
+
+def _acl_entry_factory(_: sqlite3.Cursor, row: tuple) -> AclEntry:
+    steam_id, name, added_on, last_seen = row
+    return AclEntry(steam_id, name, _from_epoch_us(added_on), _from_epoch_us(last_seen))
 
 
 class SqliteAccessControlList(AbstractAccessControlList):
@@ -26,38 +137,58 @@ class SqliteAccessControlList(AbstractAccessControlList):
     """
 
     @classmethod
-    def create(cls, dbfile: str) -> SqliteAccessControlList:
-        if os.path.isfile(dbfile):
+    def create(cls, dbfile: str, *, check_same_thread: bool = True, uri: bool = False) -> SqliteAccessControlList:
+        if os.path.isfile(_db_path(dbfile, uri)):
             raise FileExistsError(dbfile)
 
-        conn = cls.__connect(dbfile)
-        conn.execute(
-            '''
-                CREATE TABLE allowed_users (
-                    steam_id   TEXT UNIQUE NOT NULL PRIMARY KEY,
-                    name       TEXT        NOT NULL DEFAULT '',
-                    added_on   TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    last_seen  TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
+        conn = cls.__connect(dbfile, check_same_thread, uri)
+        conn.execute(_SQL_CREATE)
         return cls(conn)
 
     @classmethod
-    def open(cls, dbfile: str, create=True) -> SqliteAccessControlList:
-        if os.path.isfile(dbfile):
-            return cls(cls.__connect(dbfile))
+    def open(
+            cls,
+            dbfile: str,
+            create=True,
+            *,
+            check_same_thread: bool = True,
+            uri: bool = False,
+    ) -> SqliteAccessControlList:
+        """
+        :param dbfile: database file to open
+        :param create: create the database if it does not exist yet
+        :param check_same_thread: False to allow access from multiple threads (caller must serialize it!)
+        :param uri: dbfile is a "file:" URI (e.g. file:acl.sqlite?cache=shared)
+        """
+        if os.path.isfile(_db_path(dbfile, uri)):
+            conn = cls.__connect(dbfile, check_same_thread, uri)
+            cls.__upgrade(conn)
+            return cls(conn)
         elif create:
-            return cls.create(dbfile)
+            return cls.create(dbfile, check_same_thread=check_same_thread, uri=uri)
         else:
             raise FileNotFoundError(dbfile)
 
     def __init__(self, sqlite_conn: sqlite3.Connection):
         """
+        Note:
+            Do not share `sqlite_conn` between multiple instances - writes
+            made through one instance would not invalidate the find() cache
+            of the others (data_version only tracks *other* connections)
+
         :param sqlite_conn: open SQLite3 connection to the database
         """
         self.conn = sqlite_conn
 
+        # find() results by Steam ID (including misses), in LRU order;
+        # dropped whenever another connection commits (see data_version)
+        self._find_cache: OrderedDict[str, Optional[AclEntry]] = OrderedDict()
+        self._data_version: Optional[int] = None
+
+        # amount of entries (None = unknown); kept up to date by our own
+        # writes, and dropped along with the find() cache
+        self._len: Optional[int] = None
+
     def __enter__(self) -> SqliteAccessControlList:
         return self
 
@@ -65,43 +196,42 @@ class SqliteAccessControlList(AbstractAccessControlList):
         self.close()
 
     def __len__(self) -> int:
-        cur = self.conn.cursor()
-        cur.execute('''SELECT COUNT(*) FROM allowed_users''')
-        result = cur.fetchone()[0]
-        cur.close()
-        return result
+        self.__sync_caches()
+        if self._len is None:
+            self._len = self.conn.execute(_SQL_LEN).fetchone()[0]
+
+        return self._len
 
     def entries(self) -> Iterator[AclEntry]:
         cur = self.conn.cursor()
-        cur.execute(
-            '''
-                SELECT steam_id, name, added_on, last_seen
-                FROM allowed_users
-            ''')
+        cur.row_factory = _acl_entry_factory  # rows come out as AclEntry objects
+        cur.arraysize = ENTRIES_BATCH_SIZE
+        cur.execute(_SQL_ENTRIES)
+
+        try:
+            rows = cur.fetchmany()
+            while rows:
+                yield from rows
+                rows = cur.fetchmany()
+        finally:
+            cur.close()
 
-        for row in cur:
-            yield AclEntry(*row)
+    def find(self, steam_id: str) -> Optional[AclEntry]:
+        # hot path (every join request) -> answer from memory when possible
+        self.__sync_caches()
+        cache = self._find_cache
+        if steam_id in cache:
+            cache.move_to_end(steam_id)
+            return cache[steam_id]
 
-        cur.close()
+        row = self.conn.execute(_SQL_FIND, (steam_id,)).fetchone()
+        entry = None if row is None else AclEntry(steam_id, row[0], _from_epoch_us(row[1]), _from_epoch_us(row[2]))
 
-    def find(self, steam_id: str) -> Optional[AclEntry]:
-        cur = self.conn.cursor()
-        cur.execute(
-            '''
-                SELECT name, added_on, last_seen
-                FROM allowed_users
-                WHERE steam_id=?
-                LIMIT 1
-            ''',
-            (steam_id,))
-
-        result = cur.fetchone()
-        cur.close()
-        if not result:
-            return None
-
-        name, added_on, last_seen = result
-        return AclEntry(steam_id, name, added_on, last_seen)
+        cache[steam_id] = entry
+        if len(cache) > FIND_CACHE_SIZE:
+            cache.popitem(last=False)
+
+        return entry
 
     def add(
             self,
@@ -111,60 +241,67 @@ class SqliteAccessControlList(AbstractAccessControlList):
             *,
             last_seen: Optional[datetime] = None,
     ) -> bool:
-        if not added_on:
-            added_on = datetime.now()
-
-        if not last_seen or last_seen < added_on:
-            last_seen = added_on
-
-        cur = self.conn.execute(
-            '''
-                INSERT OR IGNORE 
-                INTO allowed_users 
-                (steam_id, name, added_on, last_seen) 
-                VALUES 
-                (?, ?, ?, ?)
-            ''',
-            (steam_id, name, added_on, last_seen))
+        added_on_us = _to_epoch_us(added_on) if added_on else _now_us()
+        last_seen_us = max(_to_epoch_us(last_seen), added_on_us) if last_seen else added_on_us
+
+        cur = self.conn.execute(_SQL_ADD, (steam_id, name, added_on_us, last_seen_us))
 
+        self._find_cache.pop(steam_id, None)
+        self.__adjust_len(cur.rowcount)
         return cur.rowcount > 0
 
     def remove(self, steam_id: str) -> bool:
-        cur = self.conn.execute(
-            '''
-                DELETE FROM allowed_users 
-                WHERE steam_id=?
-            ''',
-            (steam_id,))
+        cur = self.conn.execute(_SQL_REMOVE, (steam_id,))
 
-        success = cur.rowcount > 0
-        cur.close()
-        return success
+        self._find_cache.pop(steam_id, None)
+        self.__adjust_len(-cur.rowcount)
+        return cur.rowcount > 0
 
     def update_last_seen(self, steam_id: str, ts: Optional[datetime] = None) -> bool:
-        cur = self.conn.execute(
-            '''
-                UPDATE allowed_users
-                SET last_seen=?
-                WHERE steam_id=?
-            ''',
-            (ts or datetime.now(), steam_id))
-
-        success = cur.rowcount > 0
-        cur.close()
-        return success
+        cur = self.conn.execute(_SQL_TOUCH, (_to_epoch_us(ts) if ts else _now_us(), steam_id))
+
+        self._find_cache.pop(steam_id, None)
+        return cur.rowcount > 0
+
+    def bulk_add(self, users: Iterable[Tuple[str, str]], now: Optional[datetime] = None) -> int:
+        now_us = _to_epoch_us(now) if now else _now_us()
+        with self.transaction():
+            cur = self.conn.executemany(_SQL_ADD, ((steam_id, name, now_us, now_us) for steam_id, name in users))
+            self.__adjust_len(cur.rowcount)
+
+        return cur.rowcount
+
+    def upsert_many(self, users: Iterable[Tuple[str, str]], now: datetime):
+        now_us = _to_epoch_us(now)
+        # one transaction for the whole batch instead of a commit per user
+        with self.transaction():
+            if SQLITE_HAS_UPSERT:
+                self.conn.executemany(_SQL_UPSERT, ((steam_id, name, now_us, now_us) for steam_id, name in users))
+            else:
+                users = list(users)
+                self.conn.executemany(_SQL_TOUCH, ((now_us, steam_id) for steam_id, _ in users))
+                self.conn.executemany(_SQL_ADD, ((steam_id, name, now_us, now_us) for steam_id, name in users))
+
+            self._len = None  # rowcount doesn't tell inserts from updates
+
+    def touch_many(self, steam_ids: Iterable[str], ts: datetime) -> int:
+        ts_us = _to_epoch_us(ts)
+        with self.transaction():
+            cur = self.conn.executemany(_SQL_TOUCH, ((ts_us, steam_id) for steam_id in steam_ids))
+
+        return cur.rowcount
 
     def expire(self, min_last_seen: datetime) -> int:
-        cur = self.conn.execute(
-            '''
-                DELETE FROM allowed_users
-                WHERE last_seen < ?
-            ''',
-            (min_last_seen,))
+        cur = self.conn.execute(_SQL_EXPIRE, (_to_epoch_us(min_last_seen),))
+
+        self._find_cache.clear()
+        self.__adjust_len(-cur.rowcount)
+        return cur.rowcount
 
-        num_removed = cur.rowcount
-        cur.close()
-        return num_removed
+    def clear(self):
+        self.conn.execute(_SQL_CLEAR)
+        self._find_cache.clear()
+        self._len = 0
 
     def close(self):
         """
@@ -172,10 +309,125 @@ class SqliteAccessControlList(AbstractAccessControlList):
         """
         self.conn.close()
 
+    @contextmanager
+    def transaction(self):
+        """
+        Group multiple operations into a single transaction (one commit)
+
+        Note:
+            Nested use joins the outer transaction
+
+        Example:
+            with acl.transaction():
+                for steam_id, name in users:
+                    acl.add(steam_id, name)
+        """
+        if self.conn.in_transaction:
+            # the outer transaction commits later - but bulk writes made in
+            # here must not leave stale find() results behind until then
+            try:
+                yield
+            finally:
+                self._find_cache.clear()
+            return
+
+        self.begin()
+        try:
+            yield
+            self.commit()
+        except BaseException:
+            # a failed COMMIT (e.g. SQLITE_BUSY) leaves the transaction open
+            if self.conn.in_transaction:
+                self.rollback()
+            else:
+                self._len = None
+            raise
+
+    def begin(self):
+        """
+        Start a transaction explicitly (the connection autocommits otherwise)
+
+        Note:
+            Must be followed by either commit() or rollback() - prefer
+            transaction() where possible
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        """
+        Commit the transaction started by begin()
+        """
+        try:
+            self.conn.execute('COMMIT')
+        finally:
+            self._find_cache.clear()
+
+    def rollback(self):
+        """
+        Discard the transaction started by begin()
+        """
+        try:
+            self.conn.execute('ROLLBACK')
+        finally:
+            self._find_cache.clear()
+            self._len = None
+
     @classmethod
-    def __connect(cls, dbfile: str) -> sqlite3.Connection:
-        return sqlite3.connect(
+    def __upgrade(cls, conn: sqlite3.Connection):
+        # databases created before timestamps were stored as epoch microseconds
+        # hold them as TIMESTAMP text (local time) -> convert them in place;
+        # other processes may be opening the same file right now, so look at
+        # the schema only while holding the write lock
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            column_types = {row[1]: row[2] for row in conn.execute('PRAGMA table_info(allowed_users)')}
+            if column_types.get('added_on') == 'TIMESTAMP':
+                rows = conn.execute(_SQL_ENTRIES).fetchall()
+                conn.execute('''DROP TABLE allowed_users''')
+                conn.execute(_SQL_CREATE)
+                conn.executemany(
+                    _SQL_ADD,
+                    (
+                        (
+                            steam_id,
+                            name,
+                            _to_epoch_us(datetime.fromisoformat(added_on)),
+                            _to_epoch_us(datetime.fromisoformat(last_seen)),
+                        )
+                        for steam_id, name, added_on, last_seen
+                        in rows
+                    ))
+
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+    def __sync_caches(self):
+        # data_version changes only when *another* connection commits - our
+        # own writes invalidate their cache entries (and adjust len) directly
+        version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != self._data_version:
+            self._find_cache.clear()
+            self._len = None
+            self._data_version = version
+
+    def __adjust_len(self, delta: int):
+        if self._len is not None:
+            self._len += delta
+
+    @classmethod
+    def __connect(cls, dbfile: str, check_same_thread: bool = True, uri: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
             dbfile,
             timeout=SQLITE_TIMEOUT,
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            isolation_level=None)
+            isolation_level=None,
+            check_same_thread=check_same_thread,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+            uri=uri)
+
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+
+        return conn
@@ -9,11 +9,17 @@ Author:
 """
 
 import json
+import re
 from functools import partial
-from typing import Tuple, Callable
+from typing import Tuple, Callable, Optional
 from urllib.parse import parse_qsl, urlparse
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import orjson
+except ImportError:  # optional C-accelerated encoder
+    orjson = None
 
 __all__ = [
     'ArkJoinControlRequestHandler',
@@ -24,8 +30,32 @@ __all__ = [
 # HTML_CONTENT_TYPE = 'text/html'
 JSON_CONTENT_TYPE = 'application/json'
 
+# how long to keep an idle keep-alive connection open (secs)
+KEEPALIVE_TIMEOUT = 30.0
+
+# the request shape sent by the mod - anything else takes the slow path
+STEAM_ID_PATH_RE = re.compile(r'/\?steam_id=([0-9]{1,20})')
+
+# what the slow path accepts as a Steam ID (same as STEAM_ID_PATH_RE)
+STEAM_ID_RE = re.compile(r'[0-9]{1,20}')
+
+
+def json_dumps(obj) -> bytes:
+    """
+    :param obj: JSON-serializable object
+    :return: UTF-8 encoded JSON representation of `obj`
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    return bytes(json.dumps(obj), 'utf-8')
+
 
 class ArkJoinControlRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 -> persistent connections (every response has Content-Length)
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
     @property
     def server_version(self) -> str:
         return 'GJC/1.0'
@@ -36,32 +66,61 @@ class ArkJoinControlRequestHandler(BaseHTTPRequestHandler):
 
     # noinspection PyPep8Naming
     def do_GET(self):
+        match = STEAM_ID_PATH_RE.fullmatch(self.path)
+        steam_id = match.group(1) if match else self.parse_steam_id()
+        if steam_id:
+            self.send_access_response(steam_id, self.is_allowed(steam_id))
+
+    def parse_steam_id(self) -> Optional[str]:
+        """
+        Extract the steam_id query parameter from an arbitrary request path
+
+        Note:
+            An error response is sent if no Steam ID could be extracted
+
+        :return: Steam ID, or None if the request was answered with an error
+        """
         path = urlparse(self.path)
         query = dict(parse_qsl(path.query))
 
         if path.path != '/':
-            return self.send_error(404)
+            self.send_error(404)
+            return None
 
         steam_id = query.get('steam_id')
-        if not steam_id:
-            return self.send_error(400)
-
-        self.send_access_response(steam_id, self.is_allowed(steam_id))
-
-    def send_preamble(self, code: int, content_type: str = JSON_CONTENT_TYPE):
+        if not steam_id or not STEAM_ID_RE.fullmatch(steam_id):
+            self.send_error(400)
+            return None
+
+        return steam_id
+
+    def send_preamble(
+            self,
+            code: int,
+            content_type: str = JSON_CONTENT_TYPE,
+            content_length: Optional[int] = None,
+            close: bool = False,
+    ):
         self.send_response(code)
         self.send_header('Content-Type', content_type)
+        if content_length is not None:
+            self.send_header('Content-Length', str(content_length))
+        if close:
+            self.send_header('Connection', 'close')
         self.end_headers()
 
+    def send_json(self, code: int, response: dict):
+        json_bytes = json_dumps(response)
+        self.send_preamble(code, JSON_CONTENT_TYPE, len(json_bytes))
+        self.wfile.write(json_bytes)
+
     def send_access_response(self, steam_id: str, allowed: bool):
-        self.send_preamble(200, JSON_CONTENT_TYPE)
         response = {
             'steam_id': steam_id,
             'allowed': str(int(allowed)),
         }
 
-        json_bytes = bytes(json.dumps(response), 'utf-8')
-        self.wfile.write(json_bytes)
+        self.send_json(200, response)
 
     def send_error(self, code: int, message: str = None, explain: str = None):
         response = {
@@ -75,13 +134,28 @@ class ArkJoinControlRequestHandler(BaseHTTPRequestHandler):
         if explain:
             response['extra'] = explain
 
-        self.send_preamble(code, JSON_CONTENT_TYPE)
-        json_bytes = bytes(json.dumps(response), 'utf-8')
-        self.wfile.write(json_bytes)
+        # the request body (if any) was never read, so the connection can't
+        # be reused - it would be parsed as the next request (same as stdlib)
+        self.close_connection = True
+
+        json_bytes = json_dumps(response)
+        self.send_preamble(code, JSON_CONTENT_TYPE, len(json_bytes), close=True)
+        if self.command != 'HEAD':
+            self.wfile.write(json_bytes)
 
 
 def start_http_service(addr: Tuple[str, int], is_allowed: Callable[[str], bool]):
-    server = HTTPServer(addr, partial(ArkJoinControlRequestHandler, is_allowed))
+    """
+    Serve join requests until interrupted (CTRL+C)
+
+    Note:
+        Every connection is handled in its own thread, so `is_allowed` must
+        be thread-safe!
+
+    :param addr: (hostname, port) to listen on
+    :param is_allowed: callback deciding whether a given Steam ID may join
+    """
+    server = ThreadingHTTPServer(addr, partial(ArkJoinControlRequestHandler, is_allowed))
     try:
         server.serve_forever()
     except KeyboardInterrupt:
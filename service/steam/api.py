@@ -7,18 +7,28 @@ Author:
     IceDragon <icedragon@quickfox.org>
 """
 
-from typing import Callable
+from typing import Callable, Dict, Optional, Type
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from .model import SteamUserProfile, SteamErrorPage, SteamMembersPage
-from .parsers import SteamUserProfilePageParser, SteamMembersPageParser, SteamErrorPageParser, SteamParserError
+from .model import SteamUserProfile, SteamErrorPage, SteamMembersPage, SteamID
+from .parsers import AbstractParser, SteamUserProfilePageParser, SteamMembersPageParser, SteamErrorPageParser, \
+    SteamParserError, classify
 
 __all__ = [
     'SteamApi',
     'SteamApiError',
+    'SteamNotModified',
 ]
 
+# amount of distinct hosts to keep connection pools for
+POOL_NUM_HOSTS = 4
+
+# Steam Web API (JSON) base URL - requires an API key
+WEB_API_URL = 'https://api.steampowered.com'
+
 DO_NOTHING: Callable[[str, bytes, str], None] = lambda url, content, error_msg: None
 
 
@@ -28,6 +38,13 @@ class SteamApiError(Exception):
     """
 
 
+class SteamNotModified(SteamApiError):
+    """
+    Raised when a conditionally requested page has not changed since the last
+    time it was obtained
+    """
+
+
 class SteamApi:
     """
     A limited user-facing API to the Steam website
@@ -37,11 +54,26 @@ class SteamApi:
     MEMBERS_PAGE_PARSER = SteamMembersPageParser()
     ERROR_PAGE_PARSER = SteamErrorPageParser()
 
-    def __init__(self, on_error: Callable[[str, bytes, str], None] = DO_NOTHING):
+    def __init__(
+            self,
+            on_error: Callable[[str, bytes, str], None] = DO_NOTHING,
+            pool_size: int = 1,
+            api_key: Optional[str] = None,
+    ):
+        """
+        :param on_error: callback invoked with (url, content, error_msg) on bad responses
+        :param pool_size: amount of keep-alive connections to maintain per host
+        :param api_key: Steam Web API key (enables the web_* methods)
+        """
         session = requests.session()
         session.headers['User-Agent'] = 'SteamApiX/1.0'
+        session.mount('https://', HTTPAdapter(pool_connections=POOL_NUM_HOSTS, pool_maxsize=pool_size, max_retries=0))
         self.session = session
         self.on_error = on_error
+        self.api_key = api_key
+
+        # last seen ETag per page URL (used by conditional requests)
+        self._etags: Dict[str, str] = {}
 
     def profile(self, profile_url: str) -> SteamUserProfile:
         """
@@ -50,33 +82,137 @@ class SteamApi:
         :raises SteamApiError: could not obtain/parse profile page at given URL
         """
         try:
-            return self.PROFILE_PAGE_PARSER.parse(self._get(profile_url))
+            return self.PROFILE_PAGE_PARSER.parse(self._get(profile_url, SteamUserProfilePageParser))
         except SteamParserError as ex:
             raise SteamApiError(f'({profile_url}) {str(ex)}')
 
-    def members(self, group_id: str) -> SteamMembersPage:
+    def web_profile(self, profile_url: str) -> SteamUserProfile:
+        """
+        Obtain profile info through the Steam Web API rather than by scraping
+        the (much larger) profile page
+
+        :param profile_url: Steam profile URL (/id/<vanity> or /profiles/<steam_id>)
+        :return: Steam user profile info
+        :raises SteamApiError: no API key, unsupported URL, or lookup failed
+        """
+        path = urlparse(profile_url).path.strip('/').split('/')
+        if len(path) == 2 and path[0] == 'id':
+            steam_id = self.web_resolve_vanity(path[1])
+        elif len(path) == 2 and path[0] == 'profiles':
+            steam_id = SteamID(path[1])
+        else:
+            raise SteamApiError(f'({profile_url}) Unsupported profile URL')
+
+        return self.web_player_profile(steam_id)
+
+    def web_resolve_vanity(self, vanity: str) -> SteamID:
+        """
+        :param vanity: vanity name (as found in /id/<vanity> profile URLs)
+        :return: Steam ID of the user owning the vanity name
+        :raises SteamApiError: no API key or no such vanity name
+        """
+        response = self._get_json('ISteamUser/ResolveVanityURL/v1/', vanityurl=vanity).get('response', {})
+        if response.get('success') != 1 or 'steamid' not in response:
+            raise SteamApiError(f'(vanity: {vanity}) {response.get("message", "Cannot resolve")}')
+
+        return SteamID(response['steamid'])
+
+    def web_player_profile(self, steam_id: SteamID) -> SteamUserProfile:
+        """
+        :param steam_id: Steam ID of the user
+        :return: Steam user profile info
+        :raises SteamApiError: no API key or no such user
+        """
+        response = self._get_json('ISteamUser/GetPlayerSummaries/v2/', steamids=steam_id).get('response', {})
+        players = response.get('players', [])
+        if not players:
+            raise SteamApiError(f'(steam_id: {steam_id}) No such player')
+
+        player = players[0]
+        missing_keys = {'profileurl', 'personaname', 'steamid'} - player.keys()
+        if missing_keys:
+            raise SteamApiError(f'(steam_id: {steam_id}) Missing keys in player summary: {repr(missing_keys)}')
+
+        return SteamUserProfile(
+            url=player['profileurl'].rstrip('/'),
+            name=player['personaname'],
+            steam_id=SteamID(player['steamid']),
+        )
+
+    def members(self, group_id: str, conditional: bool = False) -> SteamMembersPage:
         """
         :param group_id: Steam group ID (used in the URL)
+        :param conditional: only obtain the page if it changed since the last call
         :return: member page
+        :raises SteamNotModified: conditional request and the page did not change
         :raises SteamApiError: could not obtain member page
         """
-        return self._members_url(f'https://steamcommunity.com/groups/{group_id}/members')
+        return self._members_url(f'https://steamcommunity.com/groups/{group_id}/members', conditional)
 
-    def _members_url(self, members_url: str) -> SteamMembersPage:
+    def _members_url(self, members_url: str, conditional: bool = False) -> SteamMembersPage:
         """
         :param members_url: Steam members page URL
+        :param conditional: only obtain the page if it changed since the last call
         :return: member page
+        :raises SteamNotModified: conditional request and the page did not change
         :raises SteamApiError: could not obtain member page
         """
+        etag = self._etags.get(members_url) if conditional else None
+        result = self._fetch(members_url, {'If-None-Match': etag} if etag else None, SteamMembersPageParser)
         try:
-            return self.MEMBERS_PAGE_PARSER.parse(self._get(members_url))
+            page = self.MEMBERS_PAGE_PARSER.parse(result.content)
         except SteamParserError as ex:
             raise SteamApiError(f'({members_url}) {str(ex)}')
 
-    def _get(self, url: str) -> bytes:
-        result = self.session.get(url)
+        # only remember pages we could actually parse
+        if 'ETag' in result.headers:
+            self._etags[members_url] = result.headers['ETag']
+
+        return page
+
+    def _get_json(self, method: str, **params: str) -> dict:
+        if not self.api_key:
+            raise SteamApiError('Steam Web API key is not configured')
+
+        # NOTE: url is used in error messages - keep the key out of it!
+        url = f'{WEB_API_URL}/{method}'
+        result = self.session.get(url, params={'key': self.api_key, **params})
+
+        def error(msg: str):
+            self.on_error(url, result.content, msg)
+            raise SteamApiError(f'({url}) {msg}')
+
+        if not result.ok:
+            error(f'Bad HTTP result ({result.status_code} {result.reason})')
+
+        try:
+            return result.json()
+        except ValueError:
+            error('Invalid JSON response')
+
+    def _get(self, url: str, expected: Optional[Type[AbstractParser]] = None) -> bytes:
+        return self._fetch(url, expected=expected).content
+
+    def _fetch(
+            self,
+            url: str,
+            headers: Optional[Dict[str, str]] = None,
+            expected: Optional[Type[AbstractParser]] = None,
+    ) -> requests.Response:
+        """
+        :param url: page URL
+        :param headers: extra request headers
+        :param expected: parser the page is meant for (None to accept any page)
+        :return: response containing the page
+        :raises SteamNotModified: conditional request and the page did not change
+        :raises SteamApiError: bad response, Steam error page, or not the `expected` page
+        """
+        result = self.session.get(url, headers=headers)
         content = result.content
 
+        if result.status_code == 304:
+            raise SteamNotModified(f'({url}) Not modified')
+
         def error(msg: str):
             self.on_error(url, content, msg)
             raise SteamApiError(f'({url}) {msg}')
@@ -88,10 +224,18 @@ class SteamApi:
         if not content_type.startswith('text/html'):
             error(f'Unsupported content type: {content_type}')
 
+        # one pass over the page markers tells error pages from the expected one
+        page_type = classify(content)
+        if page_type is not SteamErrorPageParser:
+            if expected is not None and page_type is not expected:
+                raise SteamApiError(f'({url}) unsupported page format')
+
+            return result
+
         try:
             page = self.ERROR_PAGE_PARSER.parse(result.content)
             assert isinstance(page, SteamErrorPage), repr(page)
             error(page.message)
         except SteamParserError as ex:
             # this is not an error message -> return the data
-            return result.content
+            return result
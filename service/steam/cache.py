@@ -11,18 +11,186 @@ Author:
 
 from __future__ import annotations
 
-import os
-from datetime import datetime, timedelta
-from typing import Optional
+import sys
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+from queue import SimpleQueue
+from typing import Optional, Iterable, Dict, List, Tuple
 
 import sqlite3
 
 from .model import SteamUserProfile, SteamID
 
-__all__ = ['SqliteSteamProfileCache']
+__all__ = ['SqliteSteamProfileCache', 'SqliteSteamProfileCachePool']
 
 SQLITE_TIMEOUT = 5.0  # secs
 
+# applied to every connection at open time
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',  # 256 MiB
+    'PRAGMA cache_size=-65536',  # 64 MiB
+    'PRAGMA busy_timeout=5000',  # msecs
+)
+
+# UPDATE ... RETURNING lets get() read and refresh an entry in one statement
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35)
+
+# INSERT ... ON CONFLICT DO UPDATE (SQLite 3.24+) lets put() store an entry in
+# one statement; older builds run an UPDATE and an INSERT OR IGNORE instead
+SQLITE_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24)
+
+# max amount of profile URLs per get_many() statement (older SQLite builds
+# limit a statement to 999 bound parameters)
+GET_MANY_BATCH_SIZE = 500
+
+# how many distinct profiles to hand out as shared (interned) objects
+PROFILE_INTERN_CACHE_SIZE = 4096
+
+# longer names are unlikely to repeat across profiles - don't intern them
+NAME_INTERN_MAX_LEN = 64
+
+# prepared statements are cached per connection, keyed by SQL text
+SQLITE_CACHED_STATEMENTS = 256
+
+_SQL_CREATE = '''
+    CREATE TABLE profile_cache (
+        profile_url TEXT UNIQUE NOT NULL PRIMARY KEY,
+        steam_id    TEXT        NOT NULL DEFAULT '',
+        name        TEXT        NOT NULL DEFAULT '',
+        created_on  TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_seen   TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        ttl_secs    NUMERIC     NOT NULL DEFAULT 2678400, -- 31 days
+        expires_at  REAL        NOT NULL DEFAULT 0        -- unix time (secs)
+    )
+'''
+
+_SQL_CREATE_EXPIRY_INDEX = '''
+    CREATE INDEX IF NOT EXISTS profile_cache_expires_at
+    ON profile_cache(expires_at)
+'''
+
+# upgrades cache files created before the expires_at column existed
+_SQL_ADD_EXPIRY_COLUMN = '''
+    ALTER TABLE profile_cache
+    ADD COLUMN expires_at REAL NOT NULL DEFAULT 0
+'''
+
+# last_seen was written by CURRENT_TIMESTAMP (UTC, whole seconds) on put(),
+# but by datetime.now() (local time, with microseconds) whenever an entry was
+# read - the 'utc' modifier converts the latter from local time
+#
+# unixepoch() (SQLite 3.38+) converts without going through strftime() text
+_SQL_INIT_EXPIRY = '''
+    UPDATE profile_cache
+    SET expires_at=ttl_secs + CASE
+        WHEN last_seen LIKE '%.%' THEN unixepoch(last_seen, 'utc')
+        ELSE unixepoch(last_seen)
+    END
+''' if sqlite3.sqlite_version_info >= (3, 38) else '''
+    UPDATE profile_cache
+    SET expires_at=ttl_secs + CASE
+        WHEN last_seen LIKE '%.%' THEN CAST(strftime('%s', last_seen, 'utc') AS REAL)
+        ELSE CAST(strftime('%s', last_seen) AS REAL)
+    END
+'''
+
+_SQL_LEN = '''SELECT COUNT(*) FROM profile_cache'''
+
+_SQL_GET = '''
+    UPDATE profile_cache
+    SET last_seen=CURRENT_TIMESTAMP, expires_at=? + ttl_secs
+    WHERE profile_url=?
+    RETURNING steam_id, name
+'''
+
+# {} -> placeholders for a batch of profile URLs
+_SQL_GET_MANY = '''
+    UPDATE profile_cache
+    SET last_seen=CURRENT_TIMESTAMP, expires_at=? + ttl_secs
+    WHERE profile_url IN ({})
+    RETURNING profile_url, steam_id, name
+'''
+
+# pre-3.35 fallback for _SQL_GET/_SQL_GET_MANY (followed by _SQL_TOUCH*)
+_SQL_SELECT = '''
+    SELECT steam_id, name
+    FROM profile_cache
+    WHERE profile_url=?
+    LIMIT 1
+'''
+
+_SQL_SELECT_MANY = '''
+    SELECT profile_url, steam_id, name
+    FROM profile_cache
+    WHERE profile_url IN ({})
+'''
+
+_SQL_TOUCH = '''
+    UPDATE profile_cache
+    SET last_seen=CURRENT_TIMESTAMP, expires_at=? + ttl_secs
+    WHERE profile_url=?
+'''
+
+_SQL_TOUCH_MANY = '''
+    UPDATE profile_cache
+    SET last_seen=CURRENT_TIMESTAMP, expires_at=? + ttl_secs
+    WHERE profile_url IN ({})
+'''
+
+# updates existing rows in place (REPLACE would delete + re-insert them, and
+# lose their created_on)
+_SQL_PUT = '''
+    INSERT INTO
+    profile_cache(profile_url, steam_id, name, ttl_secs, expires_at)
+    VALUES(?, ?, ?, ?, ?)
+    ON CONFLICT(profile_url) DO UPDATE SET
+        steam_id=excluded.steam_id,
+        name=excluded.name,
+        last_seen=CURRENT_TIMESTAMP,
+        ttl_secs=excluded.ttl_secs,
+        expires_at=excluded.expires_at
+'''
+
+# _SQL_PUT for SQLite < 3.24 (same parameters)
+_SQL_PUT_UPDATE = '''
+    UPDATE profile_cache
+    SET steam_id=?2, name=?3, last_seen=CURRENT_TIMESTAMP, ttl_secs=?4, expires_at=?5
+    WHERE profile_url=?1
+'''
+
+_SQL_PUT_INSERT = '''
+    INSERT OR IGNORE INTO
+    profile_cache(profile_url, steam_id, name, ttl_secs, expires_at)
+    VALUES(?, ?, ?, ?, ?)
+'''
+
+_SQL_REMOVE = '''
+    DELETE FROM profile_cache
+    WHERE profile_url=?
+'''
+
+_SQL_EXPIRE = '''
+    DELETE FROM profile_cache
+    WHERE expires_at <= ?
+'''
+
+# noinspection SqlWithoutWhere
+_SQL_CLEAR = '''DELETE FROM profile_cache'''
+
+
+@lru_cache(maxsize=PROFILE_INTERN_CACHE_SIZE)
+def _mk_profile(profile_url: str, name: str, steam_id: str) -> SteamUserProfile:
+    # repeated cache hits for the same profile share one object (and strings)
+    if len(name) < NAME_INTERN_MAX_LEN:
+        name = sys.intern(name)
+
+    return SteamUserProfile(sys.intern(profile_url), name, SteamID(sys.intern(steam_id)))
+
 
 class SqliteSteamProfileCache:
     """
@@ -31,32 +199,52 @@ class SqliteSteamProfileCache:
     """
 
     @classmethod
-    def open(cls, cache_file: str) -> SqliteSteamProfileCache:
+    def open(cls, cache_file: str, *, check_same_thread: bool = True) -> SqliteSteamProfileCache:
         """
         Open or create a cache file
 
         :param cache_file: cache file to open/create
+        :param check_same_thread: only allow the opening thread to use the cache
         :return: SteamProfileCache object for the given cache file
         """
-        create = not os.path.isfile(cache_file)
-        conn = cls.__connect(cache_file)
+        conn = cls.__connect(cache_file, check_same_thread)
         conn.row_factory = sqlite3.Row
 
-        if create:
-            conn.execute(
-                '''
-                    CREATE TABLE profile_cache (
-                        profile_url TEXT UNIQUE NOT NULL PRIMARY KEY,
-                        steam_id    TEXT        NOT NULL DEFAULT '',
-                        name        TEXT        NOT NULL DEFAULT '',
-                        created_on  TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                        last_seen   TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                        ttl_secs    NUMERIC     NOT NULL DEFAULT 2678400  -- 31 days
-                    )
-                ''')
+        # other processes may be opening the same file right now -> inspect
+        # (and create/upgrade) the schema only while holding the write lock
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(profile_cache)')}
+            if not columns:
+                conn.execute(_SQL_CREATE)
+                conn.execute(_SQL_CREATE_EXPIRY_INDEX)
+                conn.execute('ANALYZE')
+            elif 'expires_at' not in columns:
+                conn.execute(_SQL_ADD_EXPIRY_COLUMN)
+                conn.execute(_SQL_INIT_EXPIRY)
+                conn.execute(_SQL_CREATE_EXPIRY_INDEX)
+                conn.execute('ANALYZE')
+
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            conn.close()
+            raise
 
         return cls(conn)
 
+    @classmethod
+    def open_pool(cls, cache_file: str, max_conns: int = 4) -> SqliteSteamProfileCachePool:
+        """
+        Open or create a cache file, to be shared among multiple threads
+
+        :param cache_file: cache file to open/create
+        :param max_conns: max amount of connections to open to the cache file
+        :return: pool of SteamProfileCache objects for the given cache file
+        """
+        return SqliteSteamProfileCachePool(cache_file, max_conns)
+
     def __init__(self, conn: sqlite3.Connection):
         self.__conn = conn
 
@@ -70,11 +258,7 @@ class SqliteSteamProfileCache:
         """
         :return: amount of entries currently cached
         """
-        cur = self._conn.cursor()
-        cur.execute('''SELECT COUNT(*) FROM profile_cache''')
-        result = cur.fetchone()[0]
-        cur.close()
-        return result
+        return self._conn.execute(_SQL_LEN).fetchone()[0]
 
     @property
     def _conn(self) -> sqlite3.Connection:
@@ -94,25 +278,47 @@ class SqliteSteamProfileCache:
         :param profile_url: Steam profile URL
         :return: SteamUserProfile associated with the profile URL, or None if not found in cache
         """
-        cur = self._conn.cursor()
-        cur.execute(
-            '''
-                SELECT steam_id, name
-                FROM profile_cache
-                WHERE profile_url=?
-                LIMIT 1
-            ''',
-            (profile_url,))
-
-        row = cur.fetchone()
-        cur.close()
+        if SQLITE_HAS_RETURNING:
+            # fetchall() steps the statement to completion, ending the write
+            rows = self._conn.execute(_SQL_GET, (time.time(), profile_url)).fetchall()
+            if not rows:
+                return None
+
+            return _mk_profile(profile_url, rows[0]['name'], rows[0]['steam_id'])
+
+        row = self._conn.execute(_SQL_SELECT, (profile_url,)).fetchone()
         if not row:
             return None
 
-        profile = SteamUserProfile(profile_url, row['name'], SteamID(row['steam_id']))
+        profile = _mk_profile(profile_url, row['name'], row['steam_id'])
         self.__update_seen(profile_url)
         return profile
 
+    def get_many(self, profile_urls: Iterable[str]) -> Dict[str, Optional[SteamUserProfile]]:
+        """
+        Get multiple profiles from cache at once
+
+        :param profile_urls: Steam profile URLs
+        :return: {profile_url: SteamUserProfile or None if not found in cache}
+        """
+        profiles: Dict[str, Optional[SteamUserProfile]] = dict.fromkeys(profile_urls)
+        urls = list(profiles)
+        for i in range(0, len(urls), GET_MANY_BATCH_SIZE):
+            batch = urls[i:i + GET_MANY_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            if SQLITE_HAS_RETURNING:
+                rows = self._conn.execute(_SQL_GET_MANY.format(placeholders), (time.time(), *batch)).fetchall()
+            else:
+                rows = self._conn.execute(_SQL_SELECT_MANY.format(placeholders), batch).fetchall()
+                if rows:
+                    self.__update_seen_many([row['profile_url'] for row in rows])
+
+            for row in rows:
+                profile_url = row['profile_url']
+                profiles[profile_url] = _mk_profile(profile_url, row['name'], row['steam_id'])
+
+        return profiles
+
     def put(self, profile_url: str, profile: SteamUserProfile, ttl: timedelta):
         """
         Put a profile in cache, or update its expiry time
@@ -121,16 +327,44 @@ class SqliteSteamProfileCache:
         :param profile: user profile to store/update
         :param ttl: how long will this entry live without access?
         """
-        cur = self._conn.cursor()
-        cur.execute(
-            '''
-                REPLACE INTO
-                profile_cache(profile_url, steam_id, name, ttl_secs)
-                VALUES(?, ?, ?, ?)
-            ''',
-            (profile_url, profile.steam_id, profile.name, ttl.total_seconds())
+        if not SQLITE_HAS_UPSERT:
+            self.put_many([(profile_url, profile, ttl)])
+            return
+
+        ttl_secs = ttl.total_seconds()
+        self._conn.execute(_SQL_PUT, (profile_url, profile.steam_id, profile.name, ttl_secs, time.time() + ttl_secs))
+
+    def put_many(self, entries: Iterable[Tuple[str, SteamUserProfile, timedelta]]):
+        """
+        Put multiple profiles in cache (or update their expiry times) in a
+        single transaction
+
+        :param entries: (profile_url, profile, ttl) tuples - see put()
+        """
+        now = time.time()
+        rows = (
+            (profile_url, profile.steam_id, profile.name, ttl.total_seconds(), now + ttl.total_seconds())
+            for profile_url, profile, ttl
+            in entries
         )
 
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if SQLITE_HAS_UPSERT:
+                conn.executemany(_SQL_PUT, rows)
+            else:
+                rows = list(rows)
+                conn.executemany(_SQL_PUT_UPDATE, rows)
+                conn.executemany(_SQL_PUT_INSERT, rows)
+
+            conn.execute('COMMIT')
+        except BaseException:
+            # a failed COMMIT (e.g. SQLITE_BUSY) leaves the transaction open
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
     def remove(self, profile_url: str) -> bool:
         """
         Remove a Steam user profile from cache by given profile URL
@@ -138,17 +372,7 @@ class SqliteSteamProfileCache:
         :param profile_url: profile URL to remove
         :return: True if cache entry found and removed; False if not found
         """
-        cur = self._conn.cursor()
-        cur.execute(
-            '''
-                DELETE FROM profile_cache
-                WHERE profile_url=?
-            ''',
-            (profile_url,))
-
-        found = cur.rowcount > 0
-        cur.close()
-        return found
+        return self._conn.execute(_SQL_REMOVE, (profile_url,)).rowcount > 0
 
     def expire(self) -> int:
         """
@@ -156,23 +380,29 @@ class SqliteSteamProfileCache:
 
         :return: amount of entries expired
         """
-        cur = self._conn.cursor()
-        cur.execute(
-            '''
-                DELETE FROM profile_cache
-                WHERE DATETIME(last_seen, '+'||ttl_secs||' seconds') <= CURRENT_TIMESTAMP
-            ''')
-
-        num_expired = cur.rowcount
-        cur.close()
-        return num_expired
+        return self._conn.execute(_SQL_EXPIRE, (time.time(),)).rowcount
 
     def clear(self):
         """
         Clear cache to have nothing in it
         """
-        # noinspection SqlWithoutWhere
-        self._conn.execute('''DELETE FROM profile_cache''')
+        self._conn.execute(_SQL_CLEAR)
+
+    def optimize(self):
+        """
+        Let SQLite refresh query planner statistics where they are stale
+
+        Note:
+            Cheap; long-running processes should call this periodically
+        """
+        self._conn.execute('PRAGMA optimize')
+
+    def checkpoint(self):
+        """
+        Copy the write-ahead log into the cache file and truncate the log, so
+        that it doesn't keep growing (and doesn't have to be replayed on open)
+        """
+        self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
 
     def close(self):
         """
@@ -183,29 +413,122 @@ class SqliteSteamProfileCache:
             AssertionError
         """
         if self.__conn is not None:
+            try:
+                self.optimize()
+                self.checkpoint()
+            except sqlite3.Error:
+                pass  # best effort - never prevent the cache from closing
+
             self.__conn.close()
             self.__conn = None
 
         assert not self.is_open()
 
     def __update_seen(self, profile_url) -> bool:
-        cur = self._conn.cursor()
-        cur.execute(
-            '''
-                UPDATE profile_cache
-                SET last_seen=?
-                WHERE profile_url=?
-            ''',
-            (datetime.now(), profile_url))
-
-        updated = cur.rowcount > 0
-        cur.close()
-        return updated
+        return self._conn.execute(_SQL_TOUCH, (time.time(), profile_url)).rowcount > 0
+
+    def __update_seen_many(self, profile_urls: List[str]) -> int:
+        placeholders = ','.join('?' * len(profile_urls))
+        params = (time.time(), *profile_urls)
+        return self._conn.execute(_SQL_TOUCH_MANY.format(placeholders), params).rowcount
 
     @classmethod
-    def __connect(cls, dbfile: str) -> sqlite3.Connection:
-        return sqlite3.connect(
+    def __connect(cls, dbfile: str, check_same_thread: bool = True) -> sqlite3.Connection:
+        conn = sqlite3.connect(
             dbfile,
             timeout=SQLITE_TIMEOUT,
             detect_types=sqlite3.PARSE_DECLTYPES,
-            isolation_level=None)
+            isolation_level=None,
+            check_same_thread=check_same_thread,
+            cached_statements=SQLITE_CACHED_STATEMENTS)
+
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+
+        return conn
+
+
+class SqliteSteamProfileCachePool:
+    """
+    A pool of SqliteSteamProfileCache objects for the same cache file, which
+    lets threads share open connections rather than reconnecting every time.
+
+    Connections are opened lazily, up to `max_conns`; when all of them are in
+    use, the next thread waits for one to be returned.
+
+    Note:
+        p_resolver does not need this - only its main thread touches the
+        cache (resolver threads do network I/O only), so one connection does
+
+    Example:
+        with pool as cache:
+            profile = cache.get(profile_url)
+    """
+
+    def __init__(self, cache_file: str, max_conns: int = 4):
+        assert max_conns > 0, f'max_conns must be positive (got {max_conns})'
+        self.cache_file = cache_file
+        self.max_conns = max_conns
+
+        self.__free: SimpleQueue[SqliteSteamProfileCache] = SimpleQueue()
+        self.__caches: List[SqliteSteamProfileCache] = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+        # open the first one right away so that the cache file is created (or
+        # upgraded) before any worker thread gets to it
+        self.__free.put(self.__open_cache())
+
+    def __enter__(self) -> SqliteSteamProfileCache:
+        assert getattr(self.__local, 'cache', None) is None, 'this thread already checked out a cache'
+        self.__local.cache = self.checkout()
+        return self.__local.cache
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        cache, self.__local.cache = self.__local.cache, None
+        self.checkin(cache)
+
+    def __len__(self) -> int:
+        """
+        :return: amount of connections currently open
+        """
+        return len(self.__caches)
+
+    def checkout(self) -> SqliteSteamProfileCache:
+        """
+        Note:
+            Every cache checked out must be returned using checkin()
+
+        :return: cache object for exclusive use by the caller
+        """
+        if self.__free.empty():
+            with self.__lock:
+                if len(self.__caches) < self.max_conns:
+                    return self.__open_cache()
+
+        return self.__free.get()
+
+    def checkin(self, cache: SqliteSteamProfileCache):
+        """
+        :param cache: cache object previously obtained via checkout()
+        """
+        self.__free.put_nowait(cache)
+
+    def close(self):
+        """
+        Close all connections to the cache file
+
+        Note:
+            Must only be called once all caches have been returned
+        """
+        with self.__lock:
+            for cache in self.__caches:
+                cache.close()
+
+            self.__caches.clear()
+            self.__free = SimpleQueue()
+
+    def __open_cache(self) -> SqliteSteamProfileCache:
+        cache = SqliteSteamProfileCache.open(self.cache_file, check_same_thread=False)
+        self.__caches.append(cache)
+        return cache
@@ -47,8 +47,16 @@ class SteamUserProfile(NamedTuple):
     def __str__(self) -> str:
         return self.name
 
+    # NOTE: profiles are identified by steam_id alone - keep __eq__, __ne__
+    #       and __hash__ consistent (tuple's own versions use every field)
     def __eq__(self, other) -> bool:
-        return isinstance(other, self.__class__) and other.steam_id == self.steam_id
+        return self is other or (isinstance(other, self.__class__) and other.steam_id == self.steam_id)
+
+    def __ne__(self, other) -> bool:
+        return not self == other
+
+    def __hash__(self) -> int:
+        return hash(self.steam_id)
 
     def __int__(self) -> int:
         return int(self.steam_id)
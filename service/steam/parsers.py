@@ -9,11 +9,19 @@ Author:
 """
 
 from abc import ABC, abstractmethod
-from typing import Any, List
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
 
+import html as html_lib
 import json
+import re
+import lxml.etree
 import lxml.html
 
+try:
+    import orjson
+except ImportError:  # optional C-accelerated decoder
+    orjson = None
+
 from service.steam.model import SteamGroupMember, SteamUserProfile, SteamMembersPage, SteamErrorPage
 
 __all__ = [
@@ -23,14 +31,44 @@ __all__ = [
     'SteamUserProfilePageParser',
     'SteamErrorPageParser',
     'NoPageParser',
+    'classify',
 ]
 
 
+# page markers always appear near the top of a page - never scan beyond this
+# many bytes for them (bounds the cost regardless of page size)
+MARKER_SCAN_BYTES = 64 * 1024
+
+# single-line `g_rgProfileData = {...};` assignment within a profile page
+_PROFILE_DATA_RE = re.compile(rb'g_rgProfileData\s*=\s*(\{[^\n]*?\});')
+
+# first <h3> (error message) within an error page
+_H3_RE = re.compile(rb'<h3[^>]*>\s*([^<]+?)\s*</h3>', re.IGNORECASE)
+
+
 class SteamParserError(Exception):
     pass
 
 
+def _json_loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass  # stricter than json (e.g. lone surrogates) - try that too
+
+    return json.loads(data)
+
+
+def _has_marker(html: bytes, marker: bytes) -> bool:
+    # bytes.find() with bounds scans in place (no slice copy)
+    return html.find(marker, 0, MARKER_SCAN_BYTES) >= 0
+
+
 class AbstractParser(ABC):
+    # byte strings that must all be present within a supported page
+    MARKERS: Tuple[bytes, ...] = ()
+
     def parse(self, html: bytes) -> Any:
         """
         :param html: raw HTML content
@@ -73,6 +111,99 @@ class AbstractParser(ABC):
         pass
 
 
+class _MembersPageTarget:
+    """
+    lxml parser target that collects only the parts of a Steam group members
+    page that SteamMembersPageParser needs, without building a document tree.
+
+    Mirrors the XPath expressions of SteamMembersPageParser: text is collected
+    up to the first child element (i.e. the element's `.text`), and members
+    are paired with the rank icon of their .member_block like
+    SteamMembersPageParser._member_rank() does
+    """
+
+    def __init__(self):
+        self.group_names: List[str] = []
+        self.member_counts: List[str] = []
+        self.ranks: List[str] = []
+        self.links: List[Tuple[str, str]] = []
+
+        # rank of every link's .member_block (see SteamMembersPageParser._member_rank())
+        self.block_ranks: List[Optional[str]] = []
+
+        self._stack: List[Tuple[str, str]] = []
+        self._text: Optional[List[str]] = None
+        self._text_sink: Optional[Callable[[str], None]] = None
+        self._href = ''
+
+        # the .member_block currently open: its stack depth, rank and links
+        self._block_depth: Optional[int] = None
+        self._block_rank: Optional[str] = None
+        self._block_links: List[int] = []
+
+    def start(self, tag: str, attrib: Dict[str, str]):
+        self._flush_text()
+
+        # dispatch on the tag first - most elements are of no interest, and
+        # only class-less ones skip the class checks below
+        cls = attrib.get('class', '')
+        if not cls:
+            pass
+        elif tag == 'div':
+            if 'rank_icon' in cls:
+                self.ranks.append(attrib.get('title', 'UNKNOWN'))
+                if self._block_rank is None and len(self._stack) - 1 == self._block_depth \
+                        and 'rank_icon' in cls.split():
+                    self._block_rank = attrib.get('title', 'UNKNOWN')
+            elif 'member_block' in cls.split():
+                self._block_depth = len(self._stack)
+                self._block_rank = None
+                self._block_links = []
+            elif 'grouppage_header_name' in cls:
+                self._capture_text(self.group_names.append)
+        elif tag == 'a':
+            if 'linkFriend' in cls:
+                if self._block_depth is not None:
+                    self._block_links.append(len(self.block_ranks))
+                self.block_ranks.append(None)
+                self._href = attrib.get('href', '')
+                self._capture_text(lambda text: self.links.append((self._href, text)))
+        elif tag == 'span':
+            if 'count' in cls and len(self._stack) >= 2 \
+                    and self._stack[-2][0] == 'div' and 'membercount' in self._stack[-2][1]:
+                self._capture_text(self.member_counts.append)
+
+        self._stack.append((tag, cls))
+
+    def end(self, tag: str):
+        self._flush_text()
+        if self._stack:
+            self._stack.pop()
+
+        if len(self._stack) == self._block_depth:
+            # .member_block closed -> its rank icon (if any) is known now
+            for i in self._block_links:
+                self.block_ranks[i] = self._block_rank or ''
+            self._block_depth = None
+
+    def data(self, data: str):
+        if self._text is not None:
+            self._text.append(data)
+
+    def close(self) -> '_MembersPageTarget':
+        return self
+
+    def _capture_text(self, sink: Callable[[str], None]):
+        self._text = []
+        self._text_sink = sink
+
+    def _flush_text(self):
+        if self._text is not None:
+            self._text_sink(''.join(self._text))
+            self._text = None
+            self._text_sink = None
+
+
 class SteamMembersPageParser(AbstractParser):
     """
     Responsible for parsing Steam group page pages.
@@ -83,77 +214,159 @@ class SteamMembersPageParser(AbstractParser):
 
     DEFAULT_RANK = 'Member'
 
+    MARKERS = (b'<!-- member list -->', b'STEAM GROUP')
+
+    _XP_NAME = lxml.etree.XPath('//div[contains(@class,"grouppage_header_name")]/text()')
+    _XP_COUNT = lxml.etree.XPath(
+        '//div[contains(@class,"membercount")]'
+        '/*/span[contains(@class,"count")]'
+        '/text()')
+    _XP_RANKS = lxml.etree.XPath('//div[contains(@class,"rank_icon")]')
+    _XP_MEMBERS = lxml.etree.XPath('//a[contains(@class,"linkFriend")]')
+
+    def parse(self, html: bytes) -> SteamMembersPage:
+        """
+        Streams the page through a parser target that only keeps the nodes of
+        interest; falls back to a full lxml document if that fails
+
+        :param html: raw HTML content
+        :return: steam group information extracted from `html`
+        :raises SteamParserException: unsupported format or not a Steam group page
+        """
+        if not self._is_valid_html(html):
+            raise SteamParserError('unsupported page format')
+
+        parser = lxml.etree.HTMLParser(target=_MembersPageTarget(), collect_ids=False)
+        try:
+            target = lxml.etree.fromstring(html, parser)
+            ranks = target.block_ranks if self._use_block_ranks(target.block_ranks) else target.ranks
+            return self._make_page(target.group_names, target.member_counts, ranks, target.links)
+        except (lxml.etree.LxmlError, SteamParserError):
+            pass  # let the full parse deal with it (and report the error)
+
+        return super().parse(html)
+
     def _parse(self, doc: lxml.html.HtmlElement) -> SteamMembersPage:
         """
         :param doc: lxml document to parse
         :return: steam group information extracted from `html`
         :raises SteamParserException: unsupported format or not a Steam group page
         """
+        # find_class() matches whole class tokens in C; the XPath expressions
+        # (substring matches) are only used when it comes up empty
+        group_names = [it.text for it in doc.find_class('grouppage_header_name') if it.text] \
+            or self._XP_NAME(doc)
+        member_counts = [
+            it.text
+            for membercount in doc.find_class('membercount')
+            for it in membercount.find_class('count')
+            if it.tag == 'span' and it.text
+        ] or self._XP_COUNT(doc)
+        member_links = [it for it in doc.find_class('linkFriend') if it.tag == 'a'] or self._XP_MEMBERS(doc)
+
+        # each link shares a .member_block with its rank icon, so pair them
+        # up per block; only fall back to a second, document-order scan of
+        # rank icons when the blocks are missing or carry no ranks at all
+        ranks = [self._member_rank(it) for it in member_links]
+        if not self._use_block_ranks(ranks):
+            rank_icons = [it for it in doc.find_class('rank_icon') if it.tag == 'div'] or self._XP_RANKS(doc)
+            ranks = [it.attrib.get('title', 'UNKNOWN') for it in rank_icons]
+
+        return self._make_page(
+            group_names,
+            member_counts,
+            ranks,
+            [(it.attrib.get('href', ''), it.text or '') for it in member_links],
+        )
+
+    @staticmethod
+    def _use_block_ranks(block_ranks: List[Optional[str]]) -> bool:
+        """
+        :param block_ranks: rank of every member's .member_block (see _member_rank())
+        :return: False if the blocks are missing or carry no ranks at all (-> document order pairing)
+        """
+        return None not in block_ranks and any(block_ranks)
+
+    @staticmethod
+    def _member_rank(link: lxml.html.HtmlElement) -> Optional[str]:
+        """
+        :param link: linkFriend anchor of a single member
+        :return: title of the rank icon in the member's block, '' if the block
+                 has no rank icon, or None if the link is not inside a block
+        """
+        for block in link.iterancestors('div'):
+            if 'member_block' in block.attrib.get('class', '').split():
+                for icon in block.iterchildren('div'):
+                    if 'rank_icon' in icon.attrib.get('class', '').split():
+                        return icon.attrib.get('title', 'UNKNOWN')
+                return ''
+        return None
+
+    @classmethod
+    def _make_page(cls,
+                   group_names: List[str],
+                   member_counts: List[str],
+                   ranks: List[str],
+                   links: List[Tuple[str, str]]) -> SteamMembersPage:
+        """
+        :param group_names: text of group header name elements
+        :param member_counts: text of member count elements
+        :param ranks: titles of member rank icons
+        :param links: (href, text) of member profile links
+        :return: steam group information
+        :raises SteamParserException: missing or inconsistent information
+        """
         return SteamMembersPage(
-            self._parse_group_name(doc),
-            self._parse_num_members(doc),
-            self._parse_members(doc),
+            cls._parse_group_name(group_names),
+            cls._parse_num_members(member_counts),
+            cls._parse_members(ranks, links),
         )
 
     @staticmethod
-    def _parse_group_name(doc: lxml.html.HtmlElement) -> str:
-        name_xpath = doc.xpath('//div[contains(@class,"grouppage_header_name")]/text()')
-        if not name_xpath:
+    def _parse_group_name(group_names: List[str]) -> str:
+        if not group_names:
             raise SteamParserError('cannot find group_header_name')
 
-        return name_xpath[0].strip()
+        return group_names[0].strip()
 
     @staticmethod
-    def _parse_num_members(doc: lxml.html.HtmlElement) -> int:
-        membercount_xpath = doc.xpath(
-            '//div[contains(@class,"membercount")]'
-            '/*/span[contains(@class,"count")]'
-            '/text()')
-
-        if not membercount_xpath:
+    def _parse_num_members(member_counts: List[str]) -> int:
+        if not member_counts:
             raise SteamParserError('cannot find membercount')
 
         try:
-            return int(membercount_xpath[0].strip())
+            return int(member_counts[0].strip())
         except ValueError:
-            raise SteamParserError(f'membercount is not numeric: {repr(membercount_xpath)}')
+            raise SteamParserError(f'membercount is not numeric: {repr(member_counts)}')
 
     @classmethod
-    def _parse_members(cls, doc: lxml.html.HtmlElement) -> List[SteamGroupMember]:
-        ranks = [
-            it.attrib.get('title', 'UNKNOWN')
-            for it
-            in doc.xpath('//div[contains(@class,"rank_icon")]')
-        ]
-
+    def _parse_members(cls, ranks: List[str], links: List[Tuple[str, str]]) -> List[SteamGroupMember]:
         if not ranks:
             raise SteamParserError('cannot find rank icons')
 
-        members_xpath = doc.xpath('//a[contains(@class,"linkFriend")]')
-        if not members_xpath:
+        if not links:
             raise SteamParserError('cannot find linkFriend items')
 
-        if len(ranks) > len(members_xpath):
+        if len(ranks) > len(links):
             raise SteamParserError(
                 f'there are more ranks [{len(ranks)}] '
-                f'than page [{len(members_xpath)}]')
+                f'than page [{len(links)}]')
         else:
             # fill with empty ranks so that the two lists match
-            ranks.extend([''] * (len(members_xpath) - len(ranks)))
+            ranks = ranks + [''] * (len(links) - len(ranks))
 
         return [
             SteamGroupMember(
-                name=x.text.strip(),
+                name=text.strip(),
                 rank=rank or cls.DEFAULT_RANK,
-                profile_url=x.attrib.get('href', ''),
+                profile_url=href,
             )
-            for x, rank
-            in zip(members_xpath, ranks)
+            for (href, text), rank
+            in zip(links, ranks)
         ]
 
     def _is_valid_html(self, html: bytes) -> bool:
-        return b'<!-- member list -->' in html \
-               and b'STEAM GROUP' in html
+        return all(_has_marker(html, marker) for marker in self.MARKERS)
 
 
 class SteamUserProfilePageParser(AbstractParser):
@@ -165,6 +378,32 @@ class SteamUserProfilePageParser(AbstractParser):
         https://steamcommunity.com/profiles/76561198112492431
     """
 
+    MARKERS = (b'g_rgProfileData = {',)
+
+    _XP_SCRIPTS = lxml.etree.XPath('//script/text()')
+
+    def parse(self, html: bytes) -> SteamUserProfile:
+        """
+        Fast path: pull g_rgProfileData straight out of the raw HTML, without
+        building an lxml document; falls back to a full parse if that fails
+
+        :param html: raw HTML content
+        :return: steam user profile information extracted from `html`
+        """
+        if not self._is_valid_html(html):
+            raise SteamParserError('unsupported page format')
+
+        match = _PROFILE_DATA_RE.search(html)
+        if match:
+            try:
+                profile_data = _json_loads(match.group(1))
+            except ValueError:
+                pass  # let the full parse deal with it
+            else:
+                return self._make_profile(profile_data)
+
+        return super().parse(html)
+
     def _parse(self, doc: lxml.html.HtmlElement) -> SteamUserProfile:
         """
         :param doc: lxml document to parse
@@ -174,7 +413,7 @@ class SteamUserProfilePageParser(AbstractParser):
         profile_script = [
             script_text
             for script_text
-            in doc.xpath('//script/text()')
+            in self._XP_SCRIPTS(doc)
             if 'g_rgProfileData = ' in script_text
         ]
 
@@ -185,8 +424,11 @@ class SteamUserProfilePageParser(AbstractParser):
 
         # extract profile_data from within javascript
         clean_script = script_text[script_text.find('{'):script_text.find('};') + 1]
-        profile_data = json.loads(clean_script)
+        profile_data = _json_loads(clean_script)
+        return self._make_profile(profile_data)
 
+    @staticmethod
+    def _make_profile(profile_data: dict) -> SteamUserProfile:
         # ensure profile_data has all required keys
         missing_keys = {'url', 'personaname', 'steamid'} - profile_data.keys()
         if missing_keys:
@@ -199,19 +441,42 @@ class SteamUserProfilePageParser(AbstractParser):
         )
 
     def _is_valid_html(self, html: bytes) -> bool:
-        return b'g_rgProfileData = {' in html
+        return _has_marker(html, self.MARKERS[0])
 
 
 class SteamErrorPageParser(AbstractParser):
+    # present on every Steam error page
+    MARKER = b'<h2>Error</h2>'
+    MARKERS = (MARKER,)
+
+    _XP_MESSAGE = lxml.etree.XPath('//h3/text()')
+
+    def parse(self, html: bytes) -> SteamErrorPage:
+        """
+        Fast path: pull the error message straight out of the raw HTML, without
+        building an lxml document; falls back to a full parse if that fails
+
+        :param html: raw HTML content
+        :return: steam error page information extracted from `html`
+        """
+        if not self._is_valid_html(html):
+            raise SteamParserError('unsupported page format')
+
+        match = _H3_RE.search(html)
+        if match:
+            return SteamErrorPage(html_lib.unescape(match.group(1).decode('utf-8', 'replace')))
+
+        return super().parse(html)
+
     def _parse(self, doc: lxml.html.HtmlElement) -> SteamErrorPage:
-        h3 = doc.xpath('//h3/text()')
+        h3 = self._XP_MESSAGE(doc)
         if not h3:
             raise SteamParserError('cannot find h3 tags for error message')
 
         return SteamErrorPage(str(h3[0].strip()))
 
     def _is_valid_html(self, html: bytes) -> bool:
-        return b'<h2>Error</h2>' in html
+        return _has_marker(html, self.MARKER)
 
 
 class NoPageParser(AbstractParser):
@@ -227,3 +492,30 @@ class NoPageParser(AbstractParser):
 
     def __bool__(self) -> bool:
         return False
+
+
+# parsers in the order classify() tries them (error pages take precedence)
+_CLASSIFIED_PARSERS: Tuple[Type[AbstractParser], ...] = (
+    SteamErrorPageParser,
+    SteamMembersPageParser,
+    SteamUserProfilePageParser,
+)
+
+# every distinct marker used by the parsers above
+_ALL_MARKERS = tuple(dict.fromkeys(marker for parser in _CLASSIFIED_PARSERS for marker in parser.MARKERS))
+
+
+def classify(html: bytes) -> Type[AbstractParser]:
+    """
+    Determine which parser supports the given page, looking for each distinct
+    marker only once
+
+    :param html: raw HTML content
+    :return: class of the parser that supports `html`; NoPageParser if none do
+    """
+    found = {marker for marker in _ALL_MARKERS if _has_marker(html, marker)}
+    for parser in _CLASSIFIED_PARSERS:
+        if found.issuperset(parser.MARKERS):
+            return parser
+
+    return NoPageParser
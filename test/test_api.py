@@ -0,0 +1,118 @@
+import os
+from typing import Dict, List, Optional
+from unittest import TestCase
+
+import requests
+
+from service.steam.api import SteamApi, SteamApiError, SteamNotModified
+
+MEMBERS_URL = 'https://steamcommunity.com/groups/test/members'
+
+
+def make_response(
+        status_code: int,
+        content: bytes = b'',
+        headers: Optional[Dict[str, str]] = None,
+) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = 'Whatever'
+    response._content = content
+    response.headers.update({'Content-Type': 'text/html; charset=UTF-8', **(headers or {})})
+    return response
+
+
+class StubSession:
+    """
+    Stands in for requests.Session - hands out prepared responses in order
+    and records the request headers
+    """
+
+    def __init__(self, *responses: requests.Response):
+        self.responses = list(responses)
+        self.sent_headers: List[Optional[Dict[str, str]]] = []
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None, **_) -> requests.Response:
+        self.sent_headers.append(headers)
+        return self.responses.pop(0)
+
+
+class TestSteamApiConditionalRequests(TestCase):
+    def setUp(self) -> None:
+        with open(os.path.join(os.getcwd(), 'assets', 'steam-members-drake-ark-server.html'), 'rb') as f:
+            self.members_html = f.read()
+
+        self.api = SteamApi()
+
+    def test_not_modified_raises(self):
+        self.api.session = StubSession(
+            make_response(200, self.members_html, {'ETag': '"v1"'}),
+            make_response(304),
+        )
+
+        self.assertEqual('Land of Dragons Ark Server', self.api._members_url(MEMBERS_URL).group_name)
+        with self.assertRaises(SteamNotModified):
+            self.api._members_url(MEMBERS_URL, conditional=True)
+
+        self.assertEqual([None, {'If-None-Match': '"v1"'}], self.api.session.sent_headers)
+
+    def test_unconditional_request_ignores_etag(self):
+        self.api.session = StubSession(
+            make_response(200, self.members_html, {'ETag': '"v1"'}),
+            make_response(200, self.members_html, {'ETag': '"v2"'}),
+        )
+
+        self.api._members_url(MEMBERS_URL)
+        self.api._members_url(MEMBERS_URL)
+
+        self.assertEqual([None, None], self.api.session.sent_headers)
+        self.assertEqual('"v2"', self.api._etags[MEMBERS_URL])
+
+    def test_etag_is_stored_only_after_successful_parse(self):
+        self.api.session = StubSession(
+            make_response(200, b'<html><body>not a members page</body></html>', {'ETag': '"broken"'}),
+            make_response(200, self.members_html, {'ETag': '"v1"'}),
+            make_response(200, self.members_html, {'ETag': '"v1"'}),
+        )
+
+        with self.assertRaises(SteamApiError):
+            self.api._members_url(MEMBERS_URL, conditional=True)
+
+        self.assertNotIn(MEMBERS_URL, self.api._etags)
+
+        # nothing remembered yet -> the next request is not conditional
+        self.api._members_url(MEMBERS_URL, conditional=True)
+        self.api._members_url(MEMBERS_URL, conditional=True)
+
+        self.assertEqual([None, None, {'If-None-Match': '"v1"'}], self.api.session.sent_headers)
+
+
+class TestSteamApiPageRouting(TestCase):
+    @staticmethod
+    def load_asset(filename: str) -> bytes:
+        with open(os.path.join(os.getcwd(), 'assets', filename), 'rb') as f:
+            return f.read()
+
+    def setUp(self) -> None:
+        self.errors = []
+        self.api = SteamApi(on_error=lambda url, content, msg: self.errors.append(msg))
+
+    def test_error_page_raises(self):
+        self.api.session = StubSession(make_response(200, self.load_asset('steam-members-error.html')))
+
+        with self.assertRaises(SteamApiError):
+            self.api._members_url(MEMBERS_URL)
+
+        self.assertEqual(1, len(self.errors))
+
+    def test_unexpected_page_raises(self):
+        self.api.session = StubSession(make_response(200, self.load_asset('steam-profile-vas.html')))
+
+        with self.assertRaisesRegex(SteamApiError, 'unsupported page format'):
+            self.api._members_url(MEMBERS_URL)
+
+        self.assertEqual([], self.errors)
+
+    def test_expected_page_is_parsed(self):
+        self.api.session = StubSession(make_response(200, self.load_asset('steam-profile-vas.html')))
+        self.assertEqual('Vas', self.api.profile('https://steamcommunity.com/id/VasVadum').name)
@@ -1,13 +1,36 @@
 import os
-from datetime import timedelta
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta
 from tempfile import mktemp
-from time import sleep
+from time import sleep, tzset
 from unittest import TestCase
+from unittest.mock import patch
 
-from service.steam.cache import SqliteSteamProfileCache
+from service.steam.cache import SqliteSteamProfileCache, GET_MANY_BATCH_SIZE
 from service.steam.model import SteamUserProfile, SteamID
 
 
+class FailingCommitConnection:
+    """
+    Wraps an SQLite connection and fails its next COMMIT (as with SQLITE_BUSY)
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.wrapped_conn = conn
+
+    def execute(self, sql: str, *args):
+        if sql == 'COMMIT':
+            raise sqlite3.OperationalError('database is locked')
+
+        return self.wrapped_conn.execute(sql, *args)
+
+    def __getattr__(self, name: str):
+        return getattr(self.wrapped_conn, name)
+
+
 class TestSteamProfileCache(TestCase):
     def setUp(self) -> None:
         self.cache_file = mktemp(suffix='.shelf', prefix='unittest-')
@@ -52,6 +75,86 @@ class TestSteamProfileCache(TestCase):
         self.assertEqual('Test User', profile.name)
         self.assertEqual(SteamID('0999'), profile.steam_id)
 
+    def test_repeated_get_returns_shared_profile_object(self):
+        url = self.profiles[0].url
+        self.assertIs(self.cache.get(url), self.cache.get(url))
+        self.assertIs(self.cache.get(url), self.cache.get_many([url])[url])
+
+    def test_get_without_returning_support(self):
+        with patch('service.steam.cache.SQLITE_HAS_RETURNING', False):
+            self.assertIsNone(self.cache.get('http://whatever.com'))
+            for profile in self.profiles:
+                self.assertEqual(profile, self.cache.get(profile.url), msg=repr(profile))
+
+            profiles = self.cache.get_many([profile.url for profile in self.profiles])
+            self.assertEqual(self.profiles, list(profiles.values()))
+
+    def test_get_many(self):
+        missing_url = 'https://example.com/9999'
+        profile_urls = [profile.url for profile in self.profiles] + [missing_url]
+
+        profiles = self.cache.get_many(profile_urls)
+        self.assertEqual(profile_urls, list(profiles))
+        self.assertIsNone(profiles[missing_url])
+        for profile in self.profiles:
+            self.assertEqual(profile, profiles[profile.url], msg=repr(profile))
+            self.assertEqual(profile.name, profiles[profile.url].name, msg=repr(profile))
+
+    def test_get_many_spans_multiple_batches(self):
+        profile_urls = [f'https://example.com/batch/{i}' for i in range(GET_MANY_BATCH_SIZE * 2 + 1)]
+        for i, profile_url in enumerate(profile_urls):
+            self.cache.put(
+                profile_url,
+                SteamUserProfile(profile_url, f'User{i}', SteamID(str(i))),
+                ttl=timedelta(days=7))
+
+        profiles = self.cache.get_many(profile_urls)
+        self.assertEqual(len(profile_urls), len(profiles))
+        self.assertNotIn(None, profiles.values())
+
+    def test_put_existing_profile_keeps_created_on(self):
+        profile = self.profiles[0]
+        with closing(sqlite3.connect(self.cache_file)) as conn:
+            conn.execute(
+                "UPDATE profile_cache SET created_on='2000-01-01 00:00:00' WHERE profile_url=?",
+                (profile.url,))
+            conn.commit()
+
+        renamed = SteamUserProfile(profile.url, 'Renamed', profile.steam_id)
+        self.cache.put(profile.url, renamed, ttl=timedelta(days=7))
+
+        with closing(sqlite3.connect(self.cache_file)) as conn:
+            row = conn.execute(
+                'SELECT name, created_on FROM profile_cache WHERE profile_url=?',
+                (profile.url,)).fetchone()
+
+        self.assertEqual(('Renamed', '2000-01-01 00:00:00'), row)
+        self.assertEqual(len(self.profiles), len(self.cache))
+
+    def test_put_many(self):
+        self.cache.clear()
+        self.cache.put_many((profile.url, profile, timedelta(days=7)) for profile in self.profiles)
+
+        self.assertEqual(len(self.profiles), len(self.cache))
+        for profile in self.profiles:
+            self.assertEqual(profile, self.cache.get(profile.url), msg=repr(profile))
+
+    def test_put_without_upsert_support(self):
+        with patch('service.steam.cache.SQLITE_HAS_UPSERT', False):
+            self.test_put_existing_profile_keeps_created_on()
+            self.test_put_many()
+
+    def test_put_many_rolls_back_failed_commit(self):
+        conn = FailingCommitConnection(self.cache._conn)
+        with self.assertRaises(sqlite3.OperationalError):
+            SqliteSteamProfileCache(conn).put_many([
+                ('https://example.com/9999', SteamUserProfile('https://example.com/9999', 'User', SteamID('9999')),
+                 timedelta(days=7)),
+            ])
+
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(len(self.profiles), len(self.cache))
+
     def test_len(self):
         self.cache.clear()
         for i, profile in enumerate(self.profiles):
@@ -119,3 +222,134 @@ class TestSteamProfileCache(TestCase):
         self.assertFalse(self.cache.is_open())
         with self.assertRaises(AssertionError):
             len(self.cache)
+
+    def test_cache_file_uses_wal_journal(self):
+        with closing(sqlite3.connect(self.cache_file)) as conn:
+            self.assertEqual('wal', conn.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_close_truncates_write_ahead_log(self):
+        # another connection keeps the log file from being removed on close
+        with closing(sqlite3.connect(self.cache_file)) as conn:
+            conn.execute('SELECT COUNT(*) FROM profile_cache').fetchone()
+            self.assertGreater(os.path.getsize(self.cache_file + '-wal'), 0)
+            self.cache.close()
+            self.assertEqual(0, os.path.getsize(self.cache_file + '-wal'))
+
+    def test_open_switches_existing_cache_file_to_wal_journal(self):
+        self.cache.close()
+        with closing(sqlite3.connect(self.cache_file)) as conn:
+            conn.execute('PRAGMA journal_mode=DELETE')
+
+        self.cache = SqliteSteamProfileCache.open(self.cache_file)
+        self.assertEqual(len(self.profiles), len(self.cache))
+        with closing(sqlite3.connect(self.cache_file)) as conn:
+            self.assertEqual('wal', conn.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def _create_cache_file_without_expiry_column(self, rows=(
+            ('https://example.com/old', '0001', 'Old', '2000-01-01 00:00:00', 60),
+            ('https://example.com/new', '0002', 'New', '2000-01-01 00:00:00', 1e10),
+    )):
+        self.cache.close()
+        os.unlink(self.cache_file)
+        with closing(sqlite3.connect(self.cache_file)) as conn:
+            conn.execute(
+                '''
+                    CREATE TABLE profile_cache (
+                        profile_url TEXT UNIQUE NOT NULL PRIMARY KEY,
+                        steam_id    TEXT        NOT NULL DEFAULT '',
+                        name        TEXT        NOT NULL DEFAULT '',
+                        created_on  TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        last_seen   TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        ttl_secs    NUMERIC     NOT NULL DEFAULT 2678400
+                    )
+                ''')
+            conn.executemany(
+                'INSERT INTO profile_cache(profile_url, steam_id, name, last_seen, ttl_secs) VALUES(?, ?, ?, ?, ?)',
+                rows)
+            conn.commit()
+
+    def test_open_upgrades_cache_file_without_expiry_column(self):
+        self._create_cache_file_without_expiry_column()
+
+        self.cache = SqliteSteamProfileCache.open(self.cache_file)
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual(1, self.cache.expire())
+        self.assertIsNone(self.cache.get('https://example.com/old'))
+        self.assertEqual('New', self.cache.get('https://example.com/new').name)
+
+    def test_upgrade_reads_local_last_seen_as_local_time(self):
+        # UTC-5 all year round
+        self.addCleanup(tzset)
+        with patch.dict(os.environ, {'TZ': 'Etc/GMT+5'}):
+            tzset()
+
+            # the baseline stored CURRENT_TIMESTAMP on put() and datetime.now() on get()
+            now = datetime.now().replace(microsecond=0)
+            ttl_secs = 3 * 3600
+            self._create_cache_file_without_expiry_column([
+                ('https://example.com/put', '0001', 'Put', f'{datetime.utcnow():%Y-%m-%d %H:%M:%S}', ttl_secs),
+                ('https://example.com/got', '0002', 'Got', str(now - timedelta(hours=1, microseconds=-1)), ttl_secs),
+            ])
+
+            self.cache = SqliteSteamProfileCache.open(self.cache_file)
+            now_ts = now.timestamp()
+
+        expires_at = dict(self.cache._conn.execute('SELECT profile_url, expires_at FROM profile_cache').fetchall())
+        self.assertAlmostEqual(now_ts + ttl_secs, expires_at['https://example.com/put'], delta=5)
+        self.assertAlmostEqual(now_ts - 3600 + ttl_secs, expires_at['https://example.com/got'], delta=5)
+        self.assertEqual(0, self.cache.expire())
+
+    def test_open_waits_for_concurrent_upgrade(self):
+        self._create_cache_file_without_expiry_column()
+        opened = []
+
+        def open_cache():
+            with SqliteSteamProfileCache.open(self.cache_file) as cache:
+                opened.append(len(cache))
+
+        # another process is in the middle of upgrading the same file
+        with closing(sqlite3.connect(self.cache_file, isolation_level=None)) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('ALTER TABLE profile_cache ADD COLUMN expires_at REAL NOT NULL DEFAULT 0')
+            opener = threading.Thread(target=open_cache)
+            opener.start()
+            sleep(0.2)
+            conn.execute('COMMIT')
+
+        opener.join()
+        self.assertEqual([2], opened)
+
+
+class TestSteamProfileCachePool(TestCase):
+    def setUp(self) -> None:
+        self.cache_file = mktemp(suffix='.shelf', prefix='unittest-')
+        self.pool = SqliteSteamProfileCache.open_pool(self.cache_file, max_conns=2)
+
+    def tearDown(self) -> None:
+        self.pool.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.cache_file + suffix):
+                os.unlink(self.cache_file + suffix)
+
+    def test_threads_share_pooled_connections(self):
+        def worker(i: int) -> SteamUserProfile:
+            profile = SteamUserProfile(f'https://example.com/{i}', f'User{i}', SteamID(f'{i:04}'))
+            with self.pool as cache:
+                cache.put(profile.url, profile, ttl=timedelta(days=7))
+                return cache.get(profile.url)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            profiles = list(executor.map(worker, range(50)))
+
+        self.assertEqual([f'{i:04}' for i in range(50)], [profile.steam_id for profile in profiles])
+        self.assertLessEqual(len(self.pool), 2)
+        with self.pool as cache:
+            self.assertEqual(50, len(cache))
+
+    def test_checked_out_cache_is_reused(self):
+        with self.pool as cache:
+            pass
+
+        with self.pool as same_cache:
+            self.assertIs(cache, same_cache)
@@ -0,0 +1,104 @@
+import socket
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer
+from unittest import TestCase
+
+from service.httpservice import ArkJoinControlRequestHandler
+
+ALLOWED_STEAM_ID = '666'
+
+
+class QuietRequestHandler(ArkJoinControlRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class TestArkJoinControlRequestHandler(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            partial(QuietRequestHandler, lambda steam_id: steam_id == ALLOWED_STEAM_ID))
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.server_thread.join()
+
+    def request(self, raw_request: bytes) -> bytes:
+        """
+        :param raw_request: one or more raw HTTP requests to send over a single connection
+        :return: everything the server sent back until it closed the connection
+        """
+        with socket.create_connection(self.server.server_address, timeout=5.0) as sock:
+            sock.sendall(raw_request)
+            sock.shutdown(socket.SHUT_WR)
+
+            chunks = []
+            chunk = sock.recv(65536)
+            while chunk:
+                chunks.append(chunk)
+                chunk = sock.recv(65536)
+
+        return b''.join(chunks)
+
+    def test_keepalive_serves_consecutive_requests(self):
+        response = self.request(
+            b'GET /?steam_id=666 HTTP/1.1\r\nHost: localhost\r\n\r\n'
+            b'GET /?steam_id=667 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+
+        self.assertEqual(2, response.count(b'HTTP/1.1 200 '), msg=response)
+        self.assertIn(b'{"steam_id":"666","allowed":"1"}', response.replace(b' ', b''))
+        self.assertIn(b'{"steam_id":"667","allowed":"0"}', response.replace(b' ', b''))
+
+    def test_error_closes_keepalive_connection(self):
+        # the unread POST body must not be served as a follow-up request
+        smuggled = b'GET /?steam_id=666 HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        response = self.request(
+            b'POST / HTTP/1.1\r\nHost: localhost\r\n'
+            b'Content-Length: ' + str(len(smuggled)).encode() + b'\r\n\r\n' + smuggled)
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 501 '), msg=response)
+        self.assertIn(b'Connection: close\r\n', response)
+        self.assertEqual(1, response.count(b'HTTP/1.1 '), msg=response)
+
+    def test_head_error_has_no_body(self):
+        response = self.request(b'HEAD /?steam_id=666 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+        headers, _, body = response.partition(b'\r\n\r\n')
+        self.assertTrue(headers.startswith(b'HTTP/1.1 501 '), msg=response)
+        self.assertIn(b'Connection: close', headers)
+        self.assertEqual(b'', body)
+
+    def test_steam_id_path_fast_path(self):
+        response = self.request(b'GET /?steam_id=666 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 '), msg=response)
+        self.assertIn(b'{"steam_id":"666","allowed":"1"}', response.replace(b' ', b''))
+
+    def test_steam_id_query_fallback(self):
+        # extra query parameters don't match STEAM_ID_PATH_RE
+        response = self.request(b'GET /?foo=bar&steam_id=666 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 '), msg=response)
+        self.assertIn(b'{"steam_id":"666","allowed":"1"}', response.replace(b' ', b''))
+
+    def test_malformed_steam_id_is_rejected(self):
+        bad_paths = [
+            b'/?steam_id=',
+            b'/?steam_id=abc',
+            b'/?steam_id=12345678901234567890123',
+            b'/?steam_id=666%00',
+        ]
+
+        for path in bad_paths:
+            response = self.request(b'GET ' + path + b' HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            self.assertTrue(response.startswith(b'HTTP/1.1 400 '), msg=(path, response))
+
+    def test_unknown_path_is_not_found(self):
+        response = self.request(b'GET /steam_id/666 HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 404 '), msg=response)
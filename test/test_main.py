@@ -0,0 +1,129 @@
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import List
+from unittest import TestCase
+from unittest.mock import patch
+
+from service import __main__ as service_main
+from service.steam.api import SteamApi, SteamApiError, SteamNotModified
+from service.steam.model import SteamMembersPage, SteamGroupMember, SteamUserProfile, SteamID
+
+
+class StubShutdown:
+    """
+    Stands in for the shutdown Event - never blocks
+    """
+
+    def __init__(self):
+        self.flag = False
+        self.timeouts: List[float] = []
+
+    def is_set(self) -> bool:
+        return self.flag
+
+    def set(self):
+        self.flag = True
+
+    def wait(self, timeout: float = None) -> bool:
+        self.timeouts.append(timeout)
+        return self.flag
+
+
+class StubQueue:
+    def __init__(self):
+        self.items = []
+
+    def put(self, item, timeout: float = None):
+        self.items.append(item)
+
+
+class TestGroupPoller(TestCase):
+    def test_full_poll_is_forced_after_max_conditional_polls(self):
+        num_polls = service_main.G_MAX_CONDITIONAL_POLLS + 2
+        shutdown = StubShutdown()
+        conditional_flags: List[bool] = []
+        page = SteamMembersPage('Group', 1, [SteamGroupMember('User', 'Member', 'https://example.com/1')])
+
+        class StubSteamApi:
+            def __init__(self, **_):
+                pass
+
+            @staticmethod
+            def members(group_id: str, conditional: bool = False) -> SteamMembersPage:
+                conditional_flags.append(conditional)
+                if len(conditional_flags) >= num_polls:
+                    shutdown.set()
+
+                if conditional:
+                    raise SteamNotModified('not modified')
+
+                return page
+
+        q_group_updates = StubQueue()
+        with patch('service.steam.api.SteamApi', StubSteamApi), redirect_stdout(StringIO()):
+            service_main.p_group_poller(q_group_updates, 'test', 30, shutdown)
+
+        # full poll -> conditional polls until the limit -> full poll again
+        expected = [False] + [True] * (service_main.G_MAX_CONDITIONAL_POLLS - 1) + [False, True]
+        self.assertEqual(expected, conditional_flags)
+        self.assertEqual(2, len(q_group_updates.items))
+
+
+class TestResolveOne(TestCase):
+    PROFILE_URL = 'https://steamcommunity.com/id/test'
+
+    def setUp(self) -> None:
+        self.api = SteamApi(api_key='key')
+        self.profile = SteamUserProfile(self.PROFILE_URL, 'Test User', SteamID('76561198112492431'))
+        self.shutdown = StubShutdown()
+
+    def resolve(self):
+        with redirect_stdout(StringIO()):
+            return service_main.resolve_one(self.api, self.PROFILE_URL, self.shutdown)
+
+    def test_web_api_failure_falls_back_within_attempt(self):
+        with patch.object(self.api, '_get_json', side_effect=SteamApiError('rate limited')) as get_json, \
+                patch.object(self.api, 'profile', return_value=self.profile):
+            self.assertEqual((self.PROFILE_URL, self.profile, 1), self.resolve())
+
+        get_json.assert_called_once()
+        self.assertEqual([], self.shutdown.timeouts)
+
+    def test_attempts_are_bounded_and_backed_off(self):
+        with patch.object(self.api, '_get_json', side_effect=SteamApiError('bad key')) as get_json, \
+                patch.object(self.api, 'profile', side_effect=SteamApiError('no profile')) as profile:
+            self.assertEqual((self.PROFILE_URL, None, service_main.G_MAX_RESOLVE_ATTEMPTS), self.resolve())
+
+        # the Web API is not retried once it failed
+        get_json.assert_called_once()
+        self.assertEqual(service_main.G_MAX_RESOLVE_ATTEMPTS, profile.call_count)
+
+        delays = self.shutdown.timeouts
+        self.assertEqual(service_main.G_MAX_RESOLVE_ATTEMPTS - 1, len(delays))
+        self.assertTrue(all(0 < delay <= service_main.G_MAX_RESOLVE_RETRY_SECS for delay in delays), msg=repr(delays))
+
+    def test_shutdown_interrupts_backoff(self):
+        self.shutdown.set()
+        with patch.object(self.api, '_get_json', side_effect=SteamApiError('bad key')), \
+                patch.object(self.api, 'profile', side_effect=SteamApiError('no profile')) as profile:
+            self.assertEqual((self.PROFILE_URL, None, 1), self.resolve())
+
+        profile.assert_called_once()
+        self.assertEqual(1, len(self.shutdown.timeouts))
+
+    def test_web_api_success_skips_profile_page(self):
+        responses = [
+            {'response': {'success': 1, 'steamid': '76561198112492431'}},
+            {'response': {'players': [{
+                'profileurl': self.PROFILE_URL + '/',
+                'personaname': 'Test User',
+                'steamid': '76561198112492431',
+            }]}},
+        ]
+
+        with patch.object(self.api, '_get_json', side_effect=responses), \
+                patch.object(self.api, 'profile') as profile:
+            self.assertEqual((self.PROFILE_URL, self.profile, 1), self.resolve())
+
+        profile.assert_not_called()
+        self.assertEqual([], self.shutdown.timeouts)
@@ -4,7 +4,7 @@ from unittest import TestCase
 
 from service.steam.model import SteamUserProfile, SteamMembersPage, SteamGroupMember, SteamErrorPage
 from service.steam.parsers import SteamUserProfilePageParser, SteamParserError, SteamMembersPageParser, SteamErrorPageParser, \
-    NoPageParser
+    NoPageParser, AbstractParser, classify, MARKER_SCAN_BYTES
 
 
 class MyTestCase(TestCase):
@@ -45,6 +45,48 @@ class TestSteamMembersPageParser(MyTestCase, SteamMembersPageParser):
         for member in expected_members:
             self.assertIn(member, page.members, msg=member)
 
+    def test_stream_parse_matches_full_parse(self):
+        html = self.load_asset('steam-members-drake-ark-server.html')
+        self.assertEqual(AbstractParser.parse(self, html), self.parse('steam-members-drake-ark-server.html'))
+
+    def test_block_ranks_match_document_order(self):
+        html = self.load_asset('steam-members-drake-ark-server.html')
+        dom_members = AbstractParser.parse(self, html).members
+        stream_members = self.parse('steam-members-drake-ark-server.html').members
+        self.assertEqual([(it.name, it.rank) for it in dom_members],
+                         [(it.name, it.rank) for it in stream_members])
+
+    def test_ranks_pair_with_their_member_block(self):
+        # an unranked member listed before a ranked one (document order pairing would shift the ranks)
+        html = b'''<html><head><title>STEAM GROUP :: Test</title></head><body>
+            <div class="grouppage_header_name">Test Group</div>
+            <div class="membercount members"><div><span class="count">3</span></div></div>
+            <!-- member list -->
+            <div id="memberList">
+                <div class="member_block">
+                    <div class="rank_icon" title="Group Owner"><img></div>
+                    <div class="member_block_content"><a class="linkFriend" href="https://x/1">One</a></div>
+                </div>
+                <div class="member_block">
+                    <div class="member_block_content"><a class="linkFriend" href="https://x/2">Two</a></div>
+                </div>
+                <div class="member_block last">
+                    <div class="rank_icon" title="Group Moderator"><img></div>
+                    <div class="member_block_content"><a class="linkFriend" href="https://x/3">Three</a></div>
+                </div>
+            </div>
+        </body></html>'''
+
+        expected = [
+            ('One', 'Group Owner'),
+            ('Two', SteamMembersPageParser.DEFAULT_RANK),
+            ('Three', 'Group Moderator'),
+        ]
+        stream_members = SteamMembersPageParser.parse(self, html).members
+        dom_members = AbstractParser.parse(self, html).members
+        self.assertEqual(expected, [(it.name, it.rank) for it in stream_members])
+        self.assertEqual(expected, [(it.name, it.rank) for it in dom_members])
+
     def test_parse_non_group(self):
         bad_files = [
             'steam-members-error.html',
@@ -64,6 +106,11 @@ class TestSteamUserProfilePageParser(MyTestCase, SteamUserProfilePageParser):
         self.assertEqual(profile.steam_id, '76561198023716890')
         self.assertEqual(profile.name, 'Vas')
 
+    def test_fast_path_matches_full_parse(self):
+        html = self.load_asset('steam-profile-vas.html')
+        profile = AbstractParser.parse(self, html)
+        self.assertEqual(tuple(profile), tuple(self.parse('steam-profile-vas.html')))
+
     def test_parse_non_profile(self):
         bad_files = [
             'steam-members-drake-ark-server.html',
@@ -81,6 +128,14 @@ class TestSteamErrorPageParser(MyTestCase, SteamErrorPageParser):
         self.assertIsInstance(error, SteamErrorPage)
         self.assertEqual(error.message, 'No group could be retrieved for the given URL.')
 
+    def test_fast_path_matches_full_parse(self):
+        html = self.load_asset('steam-members-error.html')
+        self.assertEqual(AbstractParser.parse(self, html), self.parse('steam-members-error.html'))
+
+    def test_marker_past_scan_limit_is_ignored(self):
+        html = b' ' * MARKER_SCAN_BYTES + self.MARKER
+        self.assertFalse(self._is_valid_html(html))
+
     def test_parse_non_error(self):
         bad_files = [
             'steam-members-drake-ark-server.html',
@@ -106,3 +161,23 @@ class TestParserBooleanness(MyTestCase):
 
     def test_noparser_evaluates_to_false(self):
         self.assertFalse(NoPageParser())
+
+
+class TestClassify(MyTestCase):
+    def test_classify(self):
+        expected = {
+            'steam-members-drake-ark-server.html': SteamMembersPageParser,
+            'steam-profile-vas.html': SteamUserProfilePageParser,
+            'steam-members-error.html': SteamErrorPageParser,
+            'steam-group-error.html': SteamErrorPageParser,
+        }
+
+        for filename, parser in expected.items():
+            self.assertIs(parser, classify(self.load_asset(filename)), msg=filename)
+
+    def test_classify_unknown_page(self):
+        self.assertIs(NoPageParser, classify(b'<html><body>nothing to see here</body></html>'))
+
+    def test_classify_ignores_markers_past_scan_limit(self):
+        html = b' ' * MARKER_SCAN_BYTES + SteamErrorPageParser.MARKER
+        self.assertIs(NoPageParser, classify(html))
@@ -1,23 +1,110 @@
 import os
+import shutil
+import sqlite3
+import stat
 import tempfile
-from datetime import datetime, timedelta
+import threading
+import time
+import uuid
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
 from unittest import TestCase
+from unittest.mock import patch
 
-from service.acl.sqlite import SqliteAccessControlList
+from service.acl.base import AclEntry
+from service.acl.sqlite import SqliteAccessControlList, ENTRIES_BATCH_SIZE
+
+
+MEMORY_DB = ':memory:'
+
+# RAM-backed (where available) directory holding all database files of this
+# module; removed as a whole once the module is done
+_tmp_dir: tempfile.TemporaryDirectory
+
+# empty database to copy for file-based tests (cheaper than the DDL)
+_template_dbfile: str
+
+
+def setUpModule():
+    global _tmp_dir, _template_dbfile
+    shm_dir = '/dev/shm'
+    _tmp_dir = tempfile.TemporaryDirectory(
+        prefix='unittest-',
+        dir=shm_dir if os.access(shm_dir, os.W_OK) else None)
+
+    _template_dbfile = _temp_db_path('unittest-template-')
+    SqliteAccessControlList.create(_template_dbfile).close()
+
+
+def tearDownModule():
+    _tmp_dir.cleanup()
+
+
+def _temp_db_path(prefix: str = 'unittest-') -> str:
+    """
+    :return: path to a database file that does not exist yet
+    """
+    return os.path.join(_tmp_dir.name, f'{prefix}{uuid.uuid4().hex}.sqlite')
+
+
+class FailingCommitConnection:
+    """
+    Wraps an SQLite connection and fails its next COMMIT (as with SQLITE_BUSY)
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.wrapped_conn = conn
+
+    def execute(self, sql: str, *args):
+        if sql == 'COMMIT':
+            raise sqlite3.OperationalError('database is locked')
+
+        return self.wrapped_conn.execute(sql, *args)
+
+    def __getattr__(self, name: str):
+        return getattr(self.wrapped_conn, name)
 
 
 class TestSqliteAccessStore(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        # one in-memory database shared (and cleared) by all tests that don't
+        # care about create()/open() or persistence
+        cls.shared_db = SqliteAccessControlList.create(MEMORY_DB)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.shared_db.close()
+
     def setUp(self) -> None:
-        self.dbfile = tempfile.mktemp(prefix='unittest-', suffix='.sqlite')
-        self.assertFalse(os.path.exists(self.dbfile))
+        self.dbfile = MEMORY_DB
+        self.shared_db.clear()
+        self.db = self.shared_db
 
     def tearDown(self) -> None:
-        if os.path.exists(self.dbfile):
+        if self.dbfile == MEMORY_DB:
+            return
+
+        try:
             os.unlink(self.dbfile)
+        except FileNotFoundError:
+            pass
+
+    def _use_file_db(self, from_template: bool = False) -> str:
+        """
+        Switch this test over to a database file
 
-        self.assertFalse(os.path.exists(self.dbfile))
+        :param from_template: start with an empty database copied from the template (otherwise no file exists yet)
+        :return: path to the database file
+        """
+        self.dbfile = _temp_db_path()
+        if from_template:
+            shutil.copyfile(_template_dbfile, self.dbfile)
+
+        return self.dbfile
 
     def test_create_raises_if_file_exists(self):
+        self._use_file_db()
         db = self.dbfile
 
         with open(db, 'w') as f:
@@ -28,31 +115,153 @@ class TestSqliteAccessStore(TestCase):
             SqliteAccessControlList.create(db)
 
     def test_create_creates_and_populates_dbfile(self):
+        self._use_file_db()
         db = self.dbfile
         SqliteAccessControlList.create(db).close()
-        self.assertTrue(os.path.isfile(db))
-        self.assertGreater(os.path.getsize(db), 0)
+        st = os.stat(db)
+        self.assertTrue(stat.S_ISREG(st.st_mode))
+        self.assertGreater(st.st_size, 0)
 
     def test_open_raises_is_file_is_missing_and_create_flag_is_false(self):
+        self._use_file_db()
         db = self.dbfile
         self.assertFalse(os.path.exists(db))
         with self.assertRaises(FileNotFoundError):
             SqliteAccessControlList.open(db, create=False)
 
     def test_open_creates_file_if_missing(self):
+        self._use_file_db()
         db = self.dbfile
         self.assertFalse(os.path.exists(db))
         SqliteAccessControlList.open(db).close()
         self.assertTrue(os.path.exists(db))
 
     def test_open_succeeds_after_create(self):
+        self._use_file_db()
         db = self.dbfile
         SqliteAccessControlList.create(db).close()
         SqliteAccessControlList.open(db).close()
 
+    def test_created_and_opened_files_use_wal_journal_and_normal_sync(self):
+        self._use_file_db()
+        for db in (SqliteAccessControlList.create(self.dbfile), SqliteAccessControlList.open(self.dbfile)):
+            with db:
+                self.assertEqual('wal', db.conn.execute('PRAGMA journal_mode').fetchone()[0])
+                self.assertEqual(1, db.conn.execute('PRAGMA synchronous').fetchone()[0])  # NORMAL
+
+    def test_open_converts_timestamp_columns_to_epoch_microseconds(self):
+        self._use_file_db()
+        added_on = datetime(2020, 1, 2, 3, 4, 5, 678901)
+        last_seen = datetime(2021, 2, 3, 4, 5, 6)
+        with closing(sqlite3.connect(self.dbfile)) as conn:
+            conn.execute(
+                '''
+                    CREATE TABLE allowed_users (
+                        steam_id   TEXT UNIQUE NOT NULL PRIMARY KEY,
+                        name       TEXT        NOT NULL DEFAULT '',
+                        added_on   TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        last_seen  TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+            conn.execute(
+                'INSERT INTO allowed_users VALUES (?, ?, ?, ?)',
+                ('12345', 'Test User', added_on.isoformat(' '), last_seen.isoformat(' ')))
+            conn.commit()
+
+        with SqliteAccessControlList.open(self.dbfile) as db:
+            self.assertEqual(AclEntry('12345', 'Test User', added_on, last_seen), db.find('12345'))
+            self.assertTrue(db.add('12346', 'New User'))
+
+        with closing(sqlite3.connect(self.dbfile)) as conn:
+            self.assertEqual(
+                [('integer', 'integer')] * 2,
+                conn.execute('SELECT typeof(added_on), typeof(last_seen) FROM allowed_users').fetchall())
+
+    def test_open_converts_timestamp_columns_from_local_time(self):
+        self._use_file_db()
+        added_on = datetime(2020, 1, 2, 3, 4, 5)
+
+        # UTC-5 all year round (the old columns held datetime.now() values)
+        self.addCleanup(time.tzset)
+        with patch.dict(os.environ, {'TZ': 'Etc/GMT+5'}):
+            time.tzset()
+            with closing(sqlite3.connect(self.dbfile)) as conn:
+                conn.execute(
+                    '''
+                        CREATE TABLE allowed_users (
+                            steam_id   TEXT UNIQUE NOT NULL PRIMARY KEY,
+                            name       TEXT        NOT NULL DEFAULT '',
+                            added_on   TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                            last_seen  TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP
+                        )
+                    ''')
+                conn.execute(
+                    'INSERT INTO allowed_users VALUES (?, ?, ?, ?)',
+                    ('12345', 'Test User', added_on.isoformat(' '), added_on.isoformat(' ')))
+                conn.commit()
+
+            SqliteAccessControlList.open(self.dbfile).close()
+            expected_us = int(added_on.timestamp()) * 1_000_000
+
+        with closing(sqlite3.connect(self.dbfile)) as conn:
+            self.assertEqual(
+                [(expected_us, expected_us)],
+                conn.execute('SELECT added_on, last_seen FROM allowed_users').fetchall())
+
+        # 03:04:05 at UTC-5 is 08:04:05 UTC
+        self.assertEqual(datetime(2020, 1, 2, 8, 4, 5, tzinfo=timezone.utc).timestamp() * 1_000_000, expected_us)
+
+    def test_open_waits_for_concurrent_upgrade(self):
+        self._use_file_db()
+        added_on = datetime(2020, 1, 2, 3, 4, 5)
+        with closing(sqlite3.connect(self.dbfile)) as conn:
+            conn.execute(
+                '''
+                    CREATE TABLE allowed_users (
+                        steam_id   TEXT UNIQUE NOT NULL PRIMARY KEY,
+                        name       TEXT        NOT NULL DEFAULT '',
+                        added_on   TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        last_seen  TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+            conn.execute(
+                'INSERT INTO allowed_users VALUES (?, ?, ?, ?)',
+                ('12345', 'Test User', added_on.isoformat(' '), added_on.isoformat(' ')))
+            conn.commit()
+
+        found = []
+
+        def open_acl():
+            with SqliteAccessControlList.open(self.dbfile) as db:
+                found.append(db.find('12345'))
+
+        # another process is in the middle of upgrading the same file
+        with SqliteAccessControlList(sqlite3.connect(self.dbfile, isolation_level=None)) as upgrader:
+            upgrader.conn.execute('PRAGMA journal_mode=WAL')
+            upgrader.begin()
+            upgrader.conn.execute('DROP TABLE allowed_users')
+            upgrader.conn.execute('''CREATE TABLE allowed_users (
+                steam_id TEXT UNIQUE NOT NULL PRIMARY KEY, name TEXT NOT NULL DEFAULT '',
+                added_on INTEGER NOT NULL, last_seen INTEGER NOT NULL)''')
+            self.assertTrue(upgrader.add('12345', 'Test User', added_on))
+
+            opener = threading.Thread(target=open_acl)
+            opener.start()
+            time.sleep(0.2)
+            upgrader.commit()
+
+        opener.join()
+        self.assertEqual([AclEntry('12345', 'Test User', added_on, added_on)], found)
+
+    def test_connections_keep_temp_data_and_reads_in_memory(self):
+        self._use_file_db(from_template=True)
+        with SqliteAccessControlList.open(self.dbfile) as db:
+            self.assertEqual(2, db.conn.execute('PRAGMA temp_store').fetchone()[0])  # MEMORY
+            self.assertGreater(db.conn.execute('PRAGMA mmap_size').fetchone()[0], 0)
+            self.assertLess(db.conn.execute('PRAGMA cache_size').fetchone()[0], 0)  # sized in KiB
+
     def test_find_returns_none_if_steam_id_missing(self):
-        db = self.dbfile
-        store = SqliteAccessControlList.create(db)
+        store = self.db
         self.assertIsNone(store.find('bogus_steam_id_here'))
 
     def test_find_returns_correct_object(self):
@@ -60,7 +269,7 @@ class TestSqliteAccessStore(TestCase):
         steam_id = '31337'
         steam_user = 'Test User'
 
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
         self.assertTrue(db.add(steam_id, steam_user, now))
 
         entry = db.find(steam_id)
@@ -69,21 +278,21 @@ class TestSqliteAccessStore(TestCase):
         self.assertEqual(now, entry.added_on, msg=repr(entry))
 
     def test_add_new_user_returns_true(self):
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
         self.assertTrue(db.add('12345', 'Test User'))
 
     def test_add_existing_user_returns_false(self):
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
         self.assertTrue(db.add('12345', 'Test User'))
         self.assertFalse(db.add('12345', 'Test User'))
 
     def test_add_existing_steam_id_with_different_username_returns_false(self):
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
         self.assertTrue(db.add('12345', 'Test User'))
         self.assertFalse(db.add('12345', 'Different'))
 
     def test_add_new_steam_id_with_existing_username_adds_as_new_user(self):
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
         self.assertTrue(db.add('12345', 'Test User'))
         self.assertTrue(db.add('12346', 'Test User'))
 
@@ -96,50 +305,166 @@ class TestSqliteAccessStore(TestCase):
         self.assertEqual('Test User', user2.name)
 
     def test_remove_missing_steam_id_returns_false(self):
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
         self.assertFalse(db.remove('12345'))
         self.assertFalse(db.remove('missing'))
 
     def test_remove_existing_steam_id_returns_true_only_once(self):
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
         self.assertTrue(db.add('12345', 'Test User'))
         self.assertTrue(db.remove('12345'))
         self.assertFalse(db.remove('12345'))
 
     def test_len(self):
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
         self.assertEqual(0, len(db))
 
+        with db.transaction():
+            self.assertTrue(db.add('12345', 'User 1'))
+            self.assertEqual(1, len(db))
+
+            self.assertFalse(db.add('12345', 'User 1'))
+            self.assertEqual(1, len(db))
+
+            self.assertTrue(db.add('12346', 'User 2'))
+            self.assertEqual(2, len(db))
+
+            self.assertTrue(db.add('12347', 'User 3'))
+            self.assertEqual(3, len(db))
+
+            self.assertTrue(db.remove('12346'))
+            self.assertEqual(2, len(db))
+
+        self.assertEqual(2, len(db))
+
+    def test_len_follows_bulk_writes_and_rollbacks(self):
+        db = self.db
+        self.assertEqual(0, len(db))
+        self.assertEqual(3, db.bulk_add([('1', 'User 1'), ('2', 'User 2'), ('3', 'User 3')]))
+        self.assertEqual(3, len(db))
+
+        db.begin()
+        self.assertTrue(db.remove('1'))
+        self.assertEqual(2, len(db))
+        db.rollback()
+        self.assertEqual(3, len(db))
+
+        db.upsert_many([('3', 'User 3'), ('4', 'User 4')], datetime.now())
+        self.assertEqual(4, len(db))
+
+        self.assertEqual(4, db.expire(datetime.now() + timedelta(seconds=1)))
+        self.assertEqual(0, len(db))
+
+    def test_begin_commit_and_rollback(self):
+        db = self.db
+        db.begin()
         self.assertTrue(db.add('12345', 'User 1'))
+        db.commit()
+
+        db.begin()
+        self.assertTrue(db.add('12346', 'User 2'))
+        self.assertEqual('User 2', db.find('12346').name)
+        db.rollback()
+
         self.assertEqual(1, len(db))
+        self.assertIsNotNone(db.find('12345'))
+        self.assertIsNone(db.find('12346'))
+
+    def test_transaction_rolls_back_failed_commit(self):
+        db = SqliteAccessControlList(FailingCommitConnection(self.db.conn))
+        with self.assertRaises(sqlite3.OperationalError):
+            with db.transaction():
+                self.assertTrue(db.add('12345', 'User 1'))
+
+        self.assertFalse(db.conn.in_transaction)
+        self.assertIsNone(db.find('12345'))
+        self.assertEqual(0, len(db))
+
+    def test_transaction_rolls_back_on_error(self):
+        db = self.db
+        self.assertTrue(db.add('12345', 'User 1'))
+
+        with self.assertRaises(RuntimeError):
+            with db.transaction():
+                self.assertTrue(db.add('12346', 'User 2'))
+                self.assertTrue(db.remove('12345'))
+                raise RuntimeError('abort')
 
-        self.assertFalse(db.add('12345', 'User 1'))
         self.assertEqual(1, len(db))
+        self.assertIsNotNone(db.find('12345'))
+        self.assertIsNone(db.find('12346'))
 
-        self.assertTrue(db.add('12346', 'User 2'))
-        self.assertEqual(2, len(db))
+    def test_find_sees_bulk_writes_in_outer_transaction(self):
+        then = datetime(2020, 1, 1)
+        now = datetime.now()
 
-        self.assertTrue(db.add('12347', 'User 3'))
-        self.assertEqual(3, len(db))
+        db = self.db
+        self.assertTrue(db.add('12345', 'User 1', then))
+        with db.transaction():
+            # cache misses (and the old last_seen) first
+            self.assertIsNone(db.find('12346'))
+            self.assertIsNone(db.find('12347'))
+            self.assertEqual(then, db.find('12345').last_seen)
+
+            db.bulk_add([('12346', 'User 2')], now)
+            self.assertEqual('User 2', db.find('12346').name)
+
+            db.upsert_many([('12347', 'User 3')], now)
+            self.assertEqual('User 3', db.find('12347').name)
+
+            self.assertEqual(1, db.touch_many(['12345'], now))
+            self.assertEqual(now, db.find('12345').last_seen)
+
+    def test_bulk_add_skips_existing_users(self):
+        then = datetime.now() - timedelta(hours=1)
+        now = datetime.now()
+
+        db = self.db
+        self.assertTrue(db.add('12345', 'Old User', then))
+        self.assertEqual(1, db.bulk_add([('12345', 'Renamed User'), ('12346', 'New User')], now))
 
-        self.assertTrue(db.remove('12346'))
         self.assertEqual(2, len(db))
+        self.assertEqual(AclEntry('12345', 'Old User', then, then), db.find('12345'))
+        self.assertEqual(AclEntry('12346', 'New User', now, now), db.find('12346'))
+
+    def test_clear_removes_all_entries(self):
+        db = self.db
+        self.assertTrue(db.add('12345', 'User 1'))
+        self.assertTrue(db.add('12346', 'User 2'))
+        self.assertEqual('User 1', db.find('12345').name)
+
+        db.clear()
+        self.assertEqual(0, len(db))
+        self.assertIsNone(db.find('12345'))
 
     def test_default_add_timestamp_is_correct(self):
-        db = SqliteAccessControlList.create(self.dbfile)
+        db = self.db
 
-        lim_min = datetime.now()
+        # bound the stored value itself (epoch microseconds)
+        lim_min = time.time_ns() // 1_000
         db.add('12345', 'Test User')
-        lim_max = datetime.now() + timedelta(milliseconds=5)
+        lim_max = time.time_ns() // 1_000 + 5_000  # + 5 msecs
+
+        added_on_us = db.conn.execute('SELECT added_on FROM allowed_users WHERE steam_id=?', ('12345',)).fetchone()[0]
+        self.assertTrue(lim_min <= added_on_us < lim_max, msg=repr(added_on_us))
 
         entry = db.find('12345')
         self.assertIsInstance(entry.added_on, datetime, msg=repr(entry))
-        self.assertTrue(lim_min <= entry.added_on < lim_max, msg=repr(entry))
 
     def test_add_remove_operations_are_flushed_asap(self):
-        db1 = SqliteAccessControlList.create(self.dbfile)
+        self._use_file_db(from_template=True)
+        db1 = SqliteAccessControlList.open(self.dbfile)
         db2 = SqliteAccessControlList.open(self.dbfile)
+        self._check_add_remove_operations_are_flushed_asap(db1, db2)
 
+    def test_add_remove_operations_are_flushed_asap_with_shared_cache(self):
+        self._use_file_db(from_template=True)
+        uri = f'file:{self.dbfile}?cache=shared'
+        db1 = SqliteAccessControlList.open(uri, uri=True)
+        db2 = SqliteAccessControlList.open(uri, uri=True)
+        self._check_add_remove_operations_are_flushed_asap(db1, db2)
+
+    def _check_add_remove_operations_are_flushed_asap(self, db1: SqliteAccessControlList, db2: SqliteAccessControlList):
         self.assertEqual(0, len(db2))
         self.assertTrue(db1.add('12345', 'Test User'))
         self.assertEqual(1, len(db2))
@@ -148,6 +473,7 @@ class TestSqliteAccessStore(TestCase):
         self.assertEqual(2, len(db1))
 
     def test_persistence_with_iter(self):
+        self._use_file_db(from_template=True)
         users = [
             ('1000', 'First User'),
             ('1001', 'Second User'),
@@ -155,9 +481,8 @@ class TestSqliteAccessStore(TestCase):
             ('1003', 'Fourth User'),
         ]
 
-        with SqliteAccessControlList.create(self.dbfile) as db1:
-            for user in users:
-                self.assertTrue(db1.add(*user), msg=repr(user))
+        with SqliteAccessControlList.open(self.dbfile) as db1:
+            self.assertEqual(len(users), db1.bulk_add(users))
 
         with SqliteAccessControlList.open(self.dbfile) as db2:
             steam_ids = {u[0] for u in users}
@@ -165,3 +490,63 @@ class TestSqliteAccessStore(TestCase):
             for entry in db2:
                 self.assertIn(entry.steam_id, steam_ids, msg=repr(entry))
                 self.assertIn(entry.name, steam_names, msg=repr(entry))
+
+    def test_entries_spans_multiple_batches(self):
+        users = [(str(10000 + i), f'User {i}') for i in range(ENTRIES_BATCH_SIZE * 2 + 1)]
+        self.assertEqual(len(users), self.db.bulk_add(users))
+        self.assertEqual(sorted(users), sorted((entry.steam_id, entry.name) for entry in self.db))
+
+    def test_find_sees_changes_from_same_connection(self):
+        db = self.db
+        self.assertIsNone(db.find('12345'))
+        self.assertTrue(db.add('12345', 'Test User'))
+        self.assertEqual('Test User', db.find('12345').name)
+        self.assertTrue(db.remove('12345'))
+        self.assertIsNone(db.find('12345'))
+
+    def test_find_sees_changes_from_other_connections(self):
+        self._use_file_db(from_template=True)
+        db1 = SqliteAccessControlList.open(self.dbfile)
+        db2 = SqliteAccessControlList.open(self.dbfile)
+
+        self.assertIsNone(db1.find('12345'))
+        self.assertTrue(db2.add('12345', 'Test User'))
+        self.assertEqual('Test User', db1.find('12345').name)
+        self.assertTrue(db2.remove('12345'))
+        self.assertIsNone(db1.find('12345'))
+
+    def test_upsert_many_adds_missing_and_updates_existing(self):
+        then = datetime.now() - timedelta(hours=1)
+        now = datetime.now()
+
+        db = self.db
+        self.assertTrue(db.add('12345', 'Old User', then))
+        db.upsert_many([('12345', 'Renamed User'), ('12346', 'New User')], now)
+
+        self.assertEqual(2, len(db))
+        old_user = db.find('12345')
+        self.assertEqual('Old User', old_user.name, msg=repr(old_user))
+        self.assertEqual(then, old_user.added_on, msg=repr(old_user))
+        self.assertEqual(now, old_user.last_seen, msg=repr(old_user))
+
+        new_user = db.find('12346')
+        self.assertEqual('New User', new_user.name, msg=repr(new_user))
+        self.assertEqual(now, new_user.added_on, msg=repr(new_user))
+        self.assertEqual(now, new_user.last_seen, msg=repr(new_user))
+
+    def test_upsert_many_without_upsert_support(self):
+        with patch('service.acl.sqlite.SQLITE_HAS_UPSERT', False):
+            self.test_upsert_many_adds_missing_and_updates_existing()
+
+    def test_touch_many_updates_existing_entries_only(self):
+        then = datetime.now() - timedelta(hours=1)
+        now = datetime.now()
+
+        db = self.db
+        self.assertTrue(db.add('12345', 'User 1', then))
+        self.assertTrue(db.add('12346', 'User 2', then))
+
+        self.assertEqual(1, db.touch_many(['12345', 'missing'], now))
+        self.assertEqual(2, len(db))
+        self.assertEqual(now, db.find('12345').last_seen)
+        self.assertEqual(then, db.find('12346').last_seen)